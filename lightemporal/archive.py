@@ -0,0 +1,160 @@
+import lzma
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from .core.codec import JsonCodec
+from .core.context import ENV
+from .models import WorkflowStatus
+
+
+@dataclass
+class RetentionPolicy:
+    max_age: float
+    statuses: tuple[WorkflowStatus, ...] = (WorkflowStatus.COMPLETED,)
+
+
+class ArchiveStore:
+    def __init__(self, path='lightemporal.archive', codec=None):
+        self.path = Path(path)
+        self.codec = codec or JsonCodec()
+
+    @property
+    def _suffix(self):
+        return f'.{self.codec.name}.xz'
+
+    def _entry(self, workflow_id):
+        return self.path / f'{workflow_id}{self._suffix}'
+
+    def put(self, history):
+        # One file per workflow, written aside and renamed: a crash never damages other entries
+        entry = self._entry(history['workflow']['id'])
+        if entry.exists():
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_name(f'{entry.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp.write_bytes(lzma.compress(self.codec.dumps(history)))
+        os.replace(tmp, entry)
+
+    def _load(self, entry):
+        return self.codec.loads(lzma.decompress(entry.read_bytes()))
+
+    def get(self, workflow_id):
+        try:
+            return self._load(self._entry(workflow_id))
+        except FileNotFoundError:
+            raise KeyError(workflow_id) from None
+
+    def list(self, **filters):
+        for entry in sorted(self.path.glob(f'*{self._suffix}')):
+            history = self._load(entry)
+            row = history['workflow']
+            if all(row.get(key) == value for key, value in filters.items()):
+                yield history
+
+
+class Archiver:
+    def __init__(self, db, store, queue_id='tasks'):
+        self.db = db
+        self.store = store
+        self.workflows = db.tables['workflows']
+        self.activities = db.tables['activities']
+        self.signals = db.tables['signals']
+        self.tasks = db.tables['tasks.workflows']
+        self.queue_id = queue_id
+
+        self.workflows.create_index('status')
+        self.activities.create_index('workflow_id')
+        self.signals.create_index('workflow_id')
+
+    def _queue_tables(self, workflow_id):
+        try:
+            queue_id = self.tasks.get(workflow_id).get('queue', self.queue_id)
+        except KeyError:
+            queue_id = self.queue_id
+        return tuple(self.db.tables[f'{kind}.{queue_id}'] for kind in ('results', 'dedup', 'wakeups'))
+
+    def _results(self, workflow_id):
+        return self._queue_tables(workflow_id)[0]
+
+    def history(self, workflow_id):
+        history = {
+            'workflow': self.workflows.get(workflow_id),
+            'activities': list(self.activities.list(workflow_id=workflow_id)),
+            'signals': list(self.signals.list(workflow_id=workflow_id)),
+            'task': None,
+            'result': None,
+        }
+        try:
+            history['task'] = self.tasks.get(workflow_id)
+            history['result'] = self._results(workflow_id).get(history['task']['task_id'])
+        except KeyError:
+            pass
+        return history
+
+    def _chain(self, workflow_id):
+        ids = [workflow_id]
+        while (previous_id := self.workflows.get(ids[0]).get('previous_id')) is not None:
+            ids.insert(0, previous_id)
+        return ids
+
+    def archive(self, workflow_id):
+        # A chain of runs continued as new shares one task, it is archived with its last run
+        chain = self._chain(workflow_id)
+        queue_tables = self._queue_tables(chain[0])
+        names = [table.name for table in (self.workflows, self.activities, self.signals, self.tasks, *queue_tables)]
+        with self.db.atomic_for(*names):
+            for run_id in chain:
+                history = self._archive(run_id, *queue_tables)
+        return history
+
+    def _purge(self, table, id):
+        try:
+            table.delete(id)
+        except KeyError:
+            pass
+
+    def _archive(self, workflow_id, results, dedup, wakeups):
+        history = self.history(workflow_id)
+        # Archive first: if we crash before deleting, archiving again is a no-op
+        self.store.put(history)
+
+        for row in history['activities']:
+            self.activities.delete(row['id'])
+            # Start keys of activities whose task didn't get to drop them
+            try:
+                key = dedup.get(f'{workflow_id}:{row["name"]}')
+            except KeyError:
+                continue
+            dedup.delete(key['id'])
+            self._purge(results, key['task_id'])
+        for row in history['signals']:
+            self.signals.delete(row['id'])
+        if history['task'] is not None:
+            self.tasks.delete(workflow_id)
+            self._purge(wakeups, history['task']['task_id'])
+        if history['result'] is not None:
+            results.delete(history['result']['id'])
+        self.workflows.delete(workflow_id)
+
+        return history
+
+    def expired(self, policy, now=None):
+        limit = (time.time() if now is None else now) - policy.max_age
+        for status in policy.statuses:
+            for row in list(self.workflows.list(status=status.value)):
+                if row.get('next_id') is None and row.get('completed_at') is not None and row['completed_at'] <= limit:
+                    yield row['id']
+
+    def apply(self, policy, now=None):
+        return [self.archive(workflow_id)['workflow']['id'] for workflow_id in list(self.expired(policy, now))]
+
+
+if __name__ == '__main__':
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    store = ArchiveStore(*sys.argv[2:3])
+    for workflow_id in Archiver(ENV['DB'], store).apply(RetentionPolicy(max_age=hours * 3600)):
+        print('Archived', workflow_id)
@@ -1,76 +1,351 @@
+import contextvars
 import heapq
 import json
+import os
+import threading
 import time
-from contextlib import contextmanager
-from functools import cache, cached_property
+from contextlib import contextmanager, nullcontext
+from functools import cache, cached_property, partial
 from pathlib import Path
 
+from .codec import JsonCodec, get_codec
 from .context import ENV
 from .lock import FileLock
+from .notify import FALLBACK_POLL_TIME, Notifier
 from .utils import repeat_if_needed
 
 
+class QueueEmpty(ValueError):
+    pass
+
+
 class Backend:
-    def __init__(self, path='lightemporal.db'):
+    def __init__(self, path='lightemporal.db', group_commit=None, codec=None):
         self.path = Path(path)
+        self.codec = codec or JsonCodec()
         self._lock = FileLock(self.path.with_name(self.path.name + '.lock'), reentrant=True)
+        self._generation_path = self.path.with_name(self.path.name + '.generation')
+        self._depth = contextvars.ContextVar('transaction_depth', default=0)
+        self._read_only = contextvars.ContextVar('read_only', default=False)
+        self._group = None if group_commit is None else GroupCommit(self, group_commit)
 
         self._tables = None
+        self._version = None
+        self._indexes = {}
+        # The shared flock admits several threads of this process, they swap the in-memory state under this lock
+        self._state_lock = threading.RLock()
+        self._dirty = False
+        self._notifications = set()
+
+    @cached_property
+    def notifier(self):
+        return Notifier(self.path.with_name(self.path.name + '.notify'))
+
+    @property
+    def in_transaction(self):
+        return self._depth.get() > 0
+
+    def _current_version(self):
+        stat = self.path.stat()
+        try:
+            generation = int(self._generation_path.read_text())
+        except (FileNotFoundError, ValueError):
+            generation = 0
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns, generation
+
+    @property
+    def _read_lock(self):
+        return self._lock.shared
 
     def reload(self):
-        with self._lock:
+        if self.in_transaction:
+            return
+
+        with self._read_lock, self._state_lock:
             if not self.path.exists():
-                if not self.path.exists():
-                    self.path.write_text('{}')
-            with self.path.open() as f:
-                self._tables = json.load(f)
+                # Several processes may create it at once, never expose a partial file
+                tmp = self.path.with_name(f'{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+                tmp.write_bytes(self.codec.dumps({}))
+                os.replace(tmp, self.path)
+            version = self._current_version()
+            if self._tables is not None and version == self._version:
+                return
+            self._tables = self.codec.loads(self.path.read_bytes())
+            self._version = version
+            self._reset_indexes()
 
     def commit(self):
         with self._lock:
-            with self.path.open('w') as f:
-                json.dump(self._tables, f)
+            self.path.write_bytes(self.codec.dumps(self._tables))
+            generation = self._version[-1] + 1 if self._version else 1
+            self._generation_path.write_text(str(generation))
+            self._version = self._current_version()
+
+    def create_index(self, name, fields):
+        self._indexes.setdefault(name, {}).setdefault(tuple(fields), None)
+
+    def _reset_indexes(self):
+        for indexes in self._indexes.values():
+            for fields in indexes:
+                indexes[fields] = None
+
+    def _built_indexes(self, name):
+        indexes = self._indexes.get(name, {})
+        for fields, index in list(indexes.items()):
+            if index is None:
+                # Only publish complete indexes
+                index = {}
+                for row in self._tables.get(name, {}).values():
+                    index.setdefault(_index_key(row, fields), set()).add(row['id'])
+                indexes[fields] = index
+            yield fields, index
+
+    def _lookup(self, name, filters):
+        best = None
+        for fields, index in self._built_indexes(name):
+            if set(fields) <= filters.keys() and (best is None or len(fields) > len(best[0])):
+                best = fields, index
+        if best is None:
+            return None
+        fields, index = best
+        return index.get(_index_key(filters, fields), ())
+
+    def _index_row(self, name, row, add):
+        if name not in self._indexes:
+            return
+        for fields, index in self._built_indexes(name):
+            key = _index_key(row, fields)
+            if add:
+                index.setdefault(key, set()).add(row['id'])
+            else:
+                ids = index.get(key, set())
+                ids.discard(row['id'])
+                if not ids:
+                    index.pop(key, None)
+
+    def _touch(self, name=None):
+        if self._read_only.get():
+            raise ValueError('Cannot write in a read-only transaction')
+        self._dirty = True
+        if name is not None:
+            self._notifications.add(name)
+
+    def _begin(self):
+        self._dirty = False
+        self._notifications = set()
+
+    def _flush(self):
+        if self._dirty:
+            self.commit()
+        if self._notifications:
+            self.notifier.notify(*self._notifications)
+
+    def _set(self, name, row):
+        table = self._tables.setdefault(name, {})
+        if (old := table.get(row['id'])) is not None:
+            self._index_row(name, old, add=False)
+        table[row['id']] = row
+        self._index_row(name, row, add=True)
+
+    def _delete(self, name, id):
+        row = self._tables.setdefault(name, {}).pop(id)
+        self._index_row(name, row, add=False)
+
+    def _queue(self, name):
+        return self._tables.get(name) or {'seq': 0, 'heap': []}
+
+    def _push(self, name, priority, value):
+        queue = self._tables.setdefault(name, {'seq': 0, 'heap': []})
+        # The sequence number keeps FIFO order between equal priorities
+        heapq.heappush(queue['heap'], [priority, queue['seq'], value])
+        queue['seq'] += 1
+
+    def _pop(self, name):
+        priority, _, value = heapq.heappop(self._tables[name]['heap'])
+        return value
 
     @property
     @contextmanager
     def atomic(self):
-        with self._lock:
+        if self.in_transaction:
+            token = self._depth.set(self._depth.get() + 1)
             try:
-                self.reload()
                 yield
             finally:
-                self.commit()
+                self._depth.reset(token)
+            return
+
+        if self._group is not None:
+            with self._group.transaction():
+                yield
+            return
+
+        with self._lock:
+            self.reload()
+            self._begin()
+            try:
+                with self._transaction():
+                    yield
+            finally:
+                self._flush()
+
+    @property
+    @contextmanager
+    def atomic_read(self):
+        if self.in_transaction:
+            with self.atomic:
+                yield
+            return
+
+        with self._read_lock:
+            self.reload()
+            with self._transaction(read_only=True):
+                yield
+
+    @contextmanager
+    def _transaction(self, read_only=False):
+        depth_token = self._depth.set(1)
+        read_only_token = self._read_only.set(read_only)
+        try:
+            yield
+        finally:
+            self._read_only.reset(read_only_token)
+            self._depth.reset(depth_token)
+
+    def atomic_for(self, *names):
+        return self.atomic
+
+    def atomic_read_for(self, *names):
+        return self.atomic_read
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         self._tables = None
+        self._version = None
+        self._reset_indexes()
 
     @cached_property
     def tables(self):
-        return TableView(self)
+        return TableView(self, Table)
 
     @cached_property
     def queues(self):
-        return QueueView(self)
+        return QueueView(self, Queue)
+
 
+class _Batch:
+    def __init__(self):
+        self.loaded = threading.Event()
+        self.done = threading.Event()
+        self.running = 0
+        self.error = None
 
-class TableView:
-    def __init__(self, db):
+
+class GroupCommit:
+    def __init__(self, db, window=0.005):
         self.db = db
+        self.window = window
+        self._cond = threading.Condition()
+        self._mutex = threading.Lock()
+        self._batch = None
 
-    @cache
-    def __getitem__(self, name):
-        return Table(self.db, name)
+    @contextmanager
+    def _body(self):
+        with self._mutex, self.db._transaction():
+            yield
+
+    @contextmanager
+    def transaction(self):
+        with self._cond:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            else:
+                batch.running += 1
+
+        if leader:
+            with self._lead(batch), self._body():
+                yield
+            return
+
+        try:
+            batch.loaded.wait()
+            if batch.error is not None:
+                raise batch.error
+            with self._body():
+                yield
+        finally:
+            with self._cond:
+                batch.running -= 1
+                self._cond.notify_all()
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+    @contextmanager
+    def _lead(self, batch):
+        self.db._lock.acquire()
+        try:
+            try:
+                self.db.reload()
+                self.db._begin()
+            except BaseException as e:
+                batch.error = e
+                raise
+            finally:
+                batch.loaded.set()
+
+            yield
+            # Let concurrent writers of this process join the batch
+            time.sleep(self.window)
+        finally:
+            with self._cond:
+                self._batch = None
+                while batch.running:
+                    self._cond.wait()
+            try:
+                if batch.error is None:
+                    self.db._flush()
+            except BaseException as e:
+                batch.error = e
+                raise
+            finally:
+                self.db._lock.release()
+                batch.done.set()
+
+
+def _index_value(value):
+    try:
+        hash(value)
+    except TypeError:
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+def _index_key(row, fields):
+    return tuple(_index_value(row.get(field)) for field in fields)
 
 
-class QueueView:
-    def __init__(self, db):
+class _View:
+    def __init__(self, db, factory):
         self.db = db
+        self.factory = factory
 
     @cache
     def __getitem__(self, name):
-        return Queue(self.db, name)
+        return self.factory(self.db, name)
+
+
+class TableView(_View):
+    pass
+
+
+class QueueView(_View):
+    pass
 
 
 class _Table:
@@ -90,48 +365,97 @@ class _Table:
     def atomic(self):
         return self.db.atomic
 
+    @property
+    def atomic_read(self):
+        return self.db.atomic_read
+
+    def listen(self):
+        return self.db.notifier.listen(self.name)
+
 
 class Table(_Table):
+    def create_index(self, *fields):
+        self.db.create_index(self.name, fields)
+
     def get(self, id):
         self.db.reload()
         return self.db._tables.get(self.name, {})[id]
 
     def list(self, **filters):
-        self.db.reload()
-        for row in self.db._tables.get(self.name, {}).values():
-            if all(row.get(key) == value for key, value in filters.items()):
-                yield row
+        # Transactions of other threads change the tables in place, only read them under the lock
+        with self.db.atomic_read:
+            with self.db._state_lock:
+                rows = self.db._tables.get(self.name, {})
+                ids = self.db._lookup(self.name, filters)
+                candidates = rows.values() if ids is None else [rows[id] for id in list(ids)]
+                matches = [row for row in candidates if all(row.get(key) == value for key, value in filters.items())]
+        yield from matches
 
     def set(self, row):
         with self.db.atomic:
-            self.db._tables.setdefault(self.name, {})[row['id']] = row
+            self.db._touch(self.name)
+            self.db._set(self.name, row)
 
     def delete(self, id):
         with self.db.atomic:
-            del self.db._tables.setdefault(self.name, {})[id]
+            self.db._touch(self.name)
+            self.db._delete(self.name, id)
 
 
 class Queue(_Table):
     def get_if(self, condition, blocking=True):
-        for repeat_ctx in repeat_if_needed(
+        with self.listen() if blocking else nullcontext() as listener:
+            loop = repeat_if_needed(
                 exc_type=IndexError,
                 blocking=blocking,
-                error=ValueError('Queue is empty'),
-        ):
-            with repeat_ctx, self.db.atomic:
-                queue = self.db._tables.setdefault(self.name, [])
-                if condition(queue[0]):
-                    return queue.pop(0)
+                sleep_time=FALLBACK_POLL_TIME,
+                error=QueueEmpty('Queue is empty'),
+                wait=listener and listener.wait,
+            )
+            for repeat_ctx in loop:
+                with repeat_ctx:
+                    # Pollers only peek under the shared lock, the exclusive one is for popping
+                    with self.atomic_read:
+                        priority, _, _ = self.db._queue(self.name)['heap'][0]
+                    if condition(priority):
+                        with self.db.atomic:
+                            priority, _, _ = self.db._queue(self.name)['heap'][0]
+                            if condition(priority):
+                                self.db._touch()
+                                return self.db._pop(self.name)
 
     def get(self, blocking=True):
-        return self.get_if(lambda item: True, blocking=blocking)
+        return self.get_if(lambda priority: True, blocking=blocking)
 
-    def put(self, value):
+    def next_priority(self):
+        with self.db.atomic_read:
+            heap = self.db._queue(self.name)['heap']
+            return heap[0][0] if heap else None
+
+    def put(self, value, priority=0):
         with self.db.atomic:
-            heapq.heappush(
-                self.db._tables.setdefault(self.name, []),
-                value,
-            )
+            self.db._touch(self.name)
+            self.db._push(self.name, priority, value)
+
+
+def open_backend(path, codec=None):
+    path = str(path)
+    if path.startswith('journal:'):
+        from .journal import JournalBackend
+        return JournalBackend(path.removeprefix('journal:'), codec=codec)
+
+    if path.endswith(os.sep) or Path(path).is_dir():
+        from .sharded import ShardedBackend
+        return ShardedBackend(path, backend=partial(Backend, codec=codec))
+
+    path = Path(path)
+    if path.suffix in ('.sqlite', '.sqlite3'):
+        from .sqlite import SqliteBackend
+        return SqliteBackend(path)
+    return Backend(path, codec=codec)
 
 
-ENV.add_context('DB', Backend())
+ENV.add_context('DB', open_backend(
+    os.environ.get('LIGHTEMPORAL_DB', 'lightemporal.db'),
+    codec=get_codec(os.environ.get('LIGHTEMPORAL_CODEC', 'json')),
+))
@@ -0,0 +1,37 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    name = 'json'
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, separators=(',', ':')).encode()
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('msgpack is not installed, install lightemporal[msgpack]')
+
+    def dumps(self, value) -> bytes:
+        return msgpack.packb(value)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec)}
+
+
+def get_codec(name):
+    return CODECS[name]()
@@ -0,0 +1,173 @@
+import os
+import struct
+import threading
+import weakref
+
+from .backend import Backend
+
+
+_HEADER = struct.Struct('>I')
+GENERATION_KEY = '__generation__'
+
+
+def _frame(codec, record):
+    data = codec.dumps(record)
+    return _HEADER.pack(len(data)) + data
+
+
+def _read_frames(codec, data):
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        size, = _HEADER.unpack_from(data, offset)
+        end = offset + _HEADER.size + size
+        if end > len(data):
+            # Torn write: the record was never committed
+            break
+        yield end, codec.loads(data[offset + _HEADER.size:end])
+        offset = end
+
+
+def _read_generation(codec, f):
+    data = f.read(_HEADER.size)
+    if len(data) < _HEADER.size:
+        return None
+    size, = _HEADER.unpack(data)
+    header = f.read(size)
+    if len(header) < size:
+        return None
+    return codec.loads(header)['generation']
+
+
+_backends = weakref.WeakSet()
+
+
+def _after_fork():
+    # The compaction thread does not survive a fork
+    for db in _backends:
+        db._compacting = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class JournalBackend(Backend):
+    def __init__(self, path='lightemporal.db', compact_size=1 << 20, **kwargs):
+        super().__init__(path, **kwargs)
+        self.journal_path = self.path.with_name(self.path.name + '.journal')
+        self.compact_size = compact_size
+
+        self._generation = None
+        self._offset = 0
+        self._pending = []
+        self._compacting = threading.Lock()
+        _backends.add(self)
+
+    @property
+    def _read_lock(self):
+        # Replaying may rewrite the journal, readers need the exclusive lock
+        return self._lock
+
+    def reload(self):
+        if self.in_transaction:
+            return
+
+        with self._lock:
+            try:
+                f = self.journal_path.open('rb')
+            except FileNotFoundError:
+                generation = None
+            else:
+                with f:
+                    generation = _read_generation(self.codec, f)
+                    if self._tables is not None and generation == self._generation:
+                        f.seek(self._offset)
+                        self._replay(f.read())
+                        return
+
+            self._tables = None
+            super().reload()
+            self._generation = self._tables.pop(GENERATION_KEY, 0)
+            self._pending = []
+
+            if generation != self._generation:
+                # Missing journal, or compaction was interrupted after the
+                # snapshot was written: the snapshot is already up to date
+                self._write_journal()
+                return
+
+            with self.journal_path.open('rb') as f:
+                _read_generation(self.codec, f)
+                self._offset = f.tell()
+                self._replay(f.read())
+
+    def _replay(self, data):
+        base = self._offset
+        for end, operations in _read_frames(self.codec, data):
+            if isinstance(operations[0], str):
+                # Journals written before commits were framed as a whole hold one operation per frame
+                operations = [operations]
+            for kind, *args in operations:
+                getattr(super(), f'_{kind}')(*args)
+            self._offset = base + end
+
+    def _write_journal(self):
+        tmp = self.journal_path.with_name(self.journal_path.name + '.tmp')
+        with tmp.open('wb') as f:
+            f.write(_frame(self.codec, {'generation': self._generation}))
+            self._offset = f.tell()
+        os.replace(tmp, self.journal_path)
+
+    def _record(self, kind, *args):
+        self._pending.append([kind, *args])
+
+    def _set(self, name, row):
+        super()._set(name, row)
+        self._record('set', name, row)
+
+    def _delete(self, name, id):
+        super()._delete(name, id)
+        self._record('delete', name, id)
+
+    def _push(self, name, priority, value):
+        super()._push(name, priority, value)
+        self._record('push', name, priority, value)
+
+    def _pop(self, name):
+        value = super()._pop(name)
+        self._record('pop', name)
+        return value
+
+    def commit(self):
+        with self._lock:
+            if not self._pending:
+                return
+
+            # One frame per commit, a torn write drops the whole transaction
+            data = _frame(self.codec, self._pending)
+            with self.journal_path.open('r+b') as f:
+                f.seek(self._offset)
+                f.truncate()
+                f.write(data)
+            self._offset += len(data)
+            self._pending = []
+
+        if self._offset > self.compact_size and self._compacting.acquire(blocking=False):
+            threading.Thread(target=self._background_compact, daemon=True).start()
+
+    def _background_compact(self):
+        try:
+            self.compact()
+        finally:
+            self._compacting.release()
+
+    def compact(self):
+        with self._lock:
+            self.reload()
+            if self._offset <= self.compact_size:
+                return
+
+            self._generation += 1
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            tmp.write_bytes(self.codec.dumps({**self._tables, GENERATION_KEY: self._generation}))
+            os.replace(tmp, self.path)
+            self._write_journal()
@@ -0,0 +1,61 @@
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class Limit:
+    max_concurrent: int | None = None
+    rate: float | None = None
+    burst: int = 1
+    retry_delay: float = 1.0
+    lease: float = 300
+
+
+def find_limit(limits, name):
+    # A limit on 'module:flow' also covers 'module:flow._run', 'module:flow._create', ...
+    for key in limits or ():
+        if name == key or name.startswith(key + '.'):
+            return key
+    return None
+
+
+class Limiter:
+    def __init__(self, db, name='limits'):
+        self.table = db.tables[name]
+
+    def acquire(self, key, limit, holder, now=None):
+        now = time.time() if now is None else now
+        with self.table.atomic:
+            try:
+                row = self.table.get(key)
+            except KeyError:
+                row = {'id': key, 'tokens': limit.burst, 'updated': now, 'holders': {}}
+
+            # Holders that did not release before their lease ran out have crashed
+            holders = {id: deadline for id, deadline in row['holders'].items() if deadline > now}
+            if holder in holders:
+                return 0
+            if limit.max_concurrent is not None and len(holders) >= limit.max_concurrent:
+                return limit.retry_delay
+
+            tokens = row['tokens']
+            if limit.rate is not None:
+                tokens = min(limit.burst, tokens + (now - row['updated']) * limit.rate)
+                if tokens < 1:
+                    return (1 - tokens) / limit.rate
+                tokens -= 1
+
+            if limit.max_concurrent is not None:
+                holders[holder] = now + limit.lease
+            self.table.set({'id': key, 'tokens': tokens, 'updated': now, 'holders': holders})
+            return 0
+
+    def release(self, key, holder):
+        with self.table.atomic:
+            try:
+                row = self.table.get(key)
+            except KeyError:
+                return
+            if holder in row['holders']:
+                holders = {id: deadline for id, deadline in row['holders'].items() if id != holder}
+                self.table.set({**row, 'holders': holders})
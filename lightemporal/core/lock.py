@@ -1,15 +1,19 @@
 import contextvars
+import fcntl
+import os
 import time
+from contextlib import contextmanager
 from pathlib import Path
 
 from .utils import repeat_if_needed
 
 
 class FileLock:
-    def __init__(self, path, block=True, reentrant=False):
+    def __init__(self, path, block=True, reentrant=False, timeout=None):
         self.path = Path(path)
         self.block = block
         self.reentrant = reentrant
+        self.timeout = timeout
         self._stack = contextvars.ContextVar('stack', default=())
 
     def __enter__(self):
@@ -18,29 +22,59 @@ class FileLock:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.release()
 
-    def acquire(self, block=None):
+    @property
+    @contextmanager
+    def shared(self):
+        self.acquire(shared=True)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, block=None, shared=False, timeout=None):
         if block is None:
             block = self.block
+        if timeout is None:
+            timeout = self.timeout
 
         stack = self._stack.get()
 
         if stack:
             if self.reentrant:
+                _, held_shared = stack[0]
+                if held_shared and not shared:
+                    raise ValueError('Cannot upgrade a shared lock')
                 self._stack.set((*stack, None))
                 return
             else:
                 raise ValueError('Deadlock')
 
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX, block, timeout)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        self._stack.set(((fd, shared),))
+
+    def _flock(self, fd, operation, block, timeout):
+        if block and timeout is None:
+            fcntl.flock(fd, operation)
+            return
+
+        deadline = None if timeout is None else time.monotonic() + timeout
         for repeat_ctx in repeat_if_needed(
-                exc_type=FileExistsError,
+                exc_type=BlockingIOError,
                 blocking=block,
+                sleep_time=0.01,
                 error=ValueError('Cannot acquire lock'),
         ):
             with repeat_ctx:
-                stack = (self.path.open('x'),)
-                break
-
-        self._stack.set(stack)
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f'Cannot acquire lock {self.path} in {timeout}s')
 
     def release(self):
         stack = self._stack.get()
@@ -49,7 +83,8 @@ class FileLock:
             raise ValueError('No lock acquired')
 
         if stack[-1] is not None:
-            self.path.unlink()
-            stack[-1].close()
+            fd, _ = stack[-1]
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
 
         self._stack.set(stack[:-1])
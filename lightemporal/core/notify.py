@@ -0,0 +1,86 @@
+import select
+import socket
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from uuid import uuid4
+
+
+# Upper bound on waits, in case a notification is missed
+FALLBACK_POLL_TIME = 1.0
+
+
+class Listener:
+    def __init__(self, sockets, poll_time=0.1):
+        self.sockets = sockets
+        self.poll_time = poll_time
+
+    def wait(self, timeout):
+        if not self.sockets:
+            # No notification channel available, fall back to polling
+            time.sleep(min(timeout, self.poll_time))
+            return False
+
+        ready, _, _ = select.select(self.sockets, [], [], max(timeout, 0))
+        for sock in ready:
+            try:
+                while sock.recv(16):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(ready)
+
+
+class Subscription(Listener):
+    def __init__(self, stack, poll_time=0.1):
+        super().__init__([], poll_time)
+        self.stack = stack
+        self.tables = set()
+
+    def add(self, *tables):
+        for table in tables:
+            if table not in self.tables:
+                self.sockets.extend(self.stack.enter_context(table.listen()).sockets)
+                self.tables.add(table)
+
+
+@contextmanager
+def subscription():
+    with ExitStack() as stack:
+        yield Subscription(stack)
+
+
+class Notifier:
+    def __init__(self, directory):
+        self.directory = Path(directory).absolute()
+
+    def notify(self, *channels):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for channel in channels:
+                for path in self.directory.glob(f'{channel}/*.sock'):
+                    try:
+                        sock.sendto(b'.', str(path))
+                    except (ConnectionRefusedError, FileNotFoundError):
+                        # Listener died without cleaning up
+                        path.unlink(missing_ok=True)
+                    except (BlockingIOError, OSError):
+                        # Full buffer: the listener already has a pending wake-up
+                        pass
+
+    @contextmanager
+    def listen(self, *channels):
+        with ExitStack() as stack:
+            sockets = []
+            for channel in channels:
+                path = self.directory / channel / f'{uuid4().hex[:16]}.sock'
+                sock = stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+                try:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    sock.bind(str(path))
+                except OSError:
+                    continue
+                stack.callback(path.unlink, missing_ok=True)
+                sock.setblocking(False)
+                sockets.append(sock)
+            yield Listener(sockets)
@@ -0,0 +1,119 @@
+import contextvars
+import threading
+from contextlib import ExitStack, contextmanager
+from functools import cached_property
+from pathlib import Path
+
+from .backend import Backend, TableView, QueueView
+
+
+class _OrderedLock:
+    def __init__(self, db, shard, lock):
+        self.db = db
+        self.shard = shard
+        self.lock = lock
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    @property
+    @contextmanager
+    def shared(self):
+        self.acquire(shared=True)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, *args, **kwargs):
+        held = self.db._held.get()
+        if self.shard not in held and any(shard > self.shard for shard in held):
+            raise ValueError(f'Lock order violation: {self.shard!r} acquired after {max(held)!r}')
+        self.lock.acquire(*args, **kwargs)
+        self.db._held.set((*held, self.shard))
+
+    def release(self):
+        self.lock.release()
+        held = self.db._held.get()
+        self.db._held.set(held[:-1])
+
+
+class ShardedBackend:
+    def __init__(self, directory='lightemporal.d', groups=None, backend=Backend):
+        self.directory = Path(directory)
+        self.groups = groups or {}
+        self.backend = backend
+
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        self._held = contextvars.ContextVar('held_shards', default=())
+
+    def shard_name(self, name):
+        return self.groups.get(name, name)
+
+    def shard(self, name):
+        return self._open(self.shard_name(name))
+
+    def _open(self, shard):
+        with self._shards_lock:
+            if shard not in self._shards:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                db = self.backend(self.directory / f'{shard}.db')
+                if hasattr(db, '_lock'):
+                    db._lock = _OrderedLock(self, shard, db._lock)
+                self._shards[shard] = db.__enter__()
+            return self._shards[shard]
+
+    def _known_shards(self):
+        shards = {path.name.removesuffix('.db') for path in self.directory.glob('*.db')}
+        return sorted(shards | set(self.groups.values()) | self._shards.keys())
+
+    def reload(self):
+        for shard in self._known_shards():
+            self._open(shard).reload()
+
+    def commit(self):
+        for shard in self._known_shards():
+            self._open(shard).commit()
+
+    @contextmanager
+    def _atomic(self, shards, read_only=False):
+        with ExitStack() as stack:
+            for shard in sorted(shards):
+                db = self._open(shard)
+                stack.enter_context(db.atomic_read if read_only else db.atomic)
+            yield
+
+    def atomic_for(self, *names):
+        return self._atomic({self.shard_name(name) for name in names})
+
+    def atomic_read_for(self, *names):
+        return self._atomic({self.shard_name(name) for name in names}, read_only=True)
+
+    @property
+    def atomic(self):
+        return self._atomic(self._known_shards())
+
+    @property
+    def atomic_read(self):
+        return self._atomic(self._known_shards(), read_only=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        with self._shards_lock:
+            shards, self._shards = self._shards, {}
+        for db in shards.values():
+            db.__exit__(exc_type, exc_value, exc_tb)
+
+    @cached_property
+    def tables(self):
+        return TableView(self, lambda db, name: db.shard(name).tables[name])
+
+    @cached_property
+    def queues(self):
+        return QueueView(self, lambda db, name: db.shard(name).queues[name])
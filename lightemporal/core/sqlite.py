@@ -0,0 +1,312 @@
+import json
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager, nullcontext
+from functools import cached_property
+from pathlib import Path
+
+from .backend import QueueEmpty, TableView, QueueView
+from .notify import FALLBACK_POLL_TIME, Notifier
+from .utils import repeat_if_needed
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _extract(key):
+    path = '$.' + json.dumps(key)
+    return "json_extract(data, '" + path.replace("'", "''") + "')"
+
+
+def _is_scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+
+
+_backends = weakref.WeakSet()
+
+
+def _after_fork():
+    # SQLite connections must not be used across a fork
+    for db in _backends:
+        db._local = threading.local()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class SqliteBackend:
+    def __init__(self, path='lightemporal.sqlite', timeout=60):
+        self.path = Path(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._schemas = {}
+        _backends.add(self)
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = conn
+            self._local.depth = 0
+            self._local.read_only = False
+            self._local.created = set()
+            self._local.notifications = set()
+        return conn
+
+    @cached_property
+    def notifier(self):
+        return Notifier(self.path.with_name(self.path.name + '.notify'))
+
+    def _touch(self, name):
+        self._local.notifications.add(name)
+
+    def ensure_table(self, name, schema, indexes=()):
+        conn = self.connection
+        self._schemas.setdefault(name, (schema, indexes))
+        if name not in self._local.created:
+            # Only reached for tables first used inside atomic_read, the others are created before it
+            with self._writable(conn) if self._local.read_only else nullcontext():
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {_quote(name)} ({schema})')
+                for columns in indexes:
+                    index_name = _quote(f'{name}:{columns}')
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {_quote(name)} ({columns})')
+            self._local.created.add(name)
+        return conn
+
+    @contextmanager
+    def _writable(self, conn):
+        conn.execute('PRAGMA query_only = OFF')
+        try:
+            yield
+        finally:
+            conn.execute('PRAGMA query_only = ON')
+
+    def reload(self):
+        pass
+
+    def commit(self):
+        pass
+
+    @property
+    @contextmanager
+    def atomic(self):
+        conn = self.connection
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        with self._transaction(conn, 'BEGIN IMMEDIATE'):
+            yield
+
+    @property
+    def atomic_read(self):
+        return self._atomic_read(self._schemas)
+
+    @contextmanager
+    def _atomic_read(self, names):
+        conn = self.connection
+        if self._local.depth:
+            with self.atomic:
+                yield
+            return
+
+        # Creating a table is a write, do it before the connection turns read-only
+        for name in list(names):
+            if name in self._schemas:
+                self.ensure_table(name, *self._schemas[name])
+
+        conn.execute('PRAGMA query_only = ON')
+        self._local.read_only = True
+        try:
+            with self._transaction(conn, 'BEGIN DEFERRED'):
+                yield
+        finally:
+            self._local.read_only = False
+            conn.execute('PRAGMA query_only = OFF')
+
+    @contextmanager
+    def _transaction(self, conn, begin):
+        conn.execute(begin)
+        self._local.depth = 1
+        self._local.notifications = set()
+        try:
+            yield
+        except BaseException:
+            self._local.depth = 0
+            conn.execute('ROLLBACK')
+            # Tables created in the transaction are gone
+            self._local.created.clear()
+            raise
+        else:
+            self._local.depth = 0
+            conn.execute('COMMIT')
+            if self._local.notifications:
+                self.notifier.notify(*self._local.notifications)
+
+    def atomic_for(self, *names):
+        return self.atomic
+
+    def atomic_read_for(self, *names):
+        return self._atomic_read(names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    @cached_property
+    def tables(self):
+        return TableView(self, SqliteTable)
+
+    @cached_property
+    def queues(self):
+        return QueueView(self, SqliteQueue)
+
+
+class _SqliteTable:
+    schema = None
+    indexes = ()
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.quoted = _quote(name)
+        db._schemas.setdefault(name, (self.schema, self.indexes))
+
+    @property
+    def reload(self):
+        return self.db.reload
+
+    @property
+    def commit(self):
+        return self.db.commit
+
+    @property
+    def atomic(self):
+        return self.db.atomic
+
+    @property
+    def atomic_read(self):
+        return self.db.atomic_read_for(self.name)
+
+    @property
+    def connection(self):
+        return self.db.ensure_table(self.name, self.schema, self.indexes)
+
+    def listen(self):
+        return self.db.notifier.listen(self.name)
+
+
+class SqliteTable(_SqliteTable):
+    schema = 'id TEXT PRIMARY KEY, data TEXT NOT NULL'
+
+    def create_index(self, *fields):
+        index_name = _quote(f'{self.name}:{",".join(fields)}')
+        columns = ', '.join(_extract(field) for field in fields)
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {self.quoted} ({columns})')
+
+    def get(self, id):
+        row = self.connection.execute(f'SELECT data FROM {self.quoted} WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return json.loads(row[0])
+
+    def list(self, **filters):
+        clauses, params = [], []
+        for key, value in filters.items():
+            if not _is_scalar(value):
+                continue
+            if value is None:
+                clauses.append(f'{_extract(key)} IS NULL')
+            else:
+                clauses.append(f'{_extract(key)} = ?')
+                params.append(value)
+
+        query = f'SELECT data FROM {self.quoted}'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+
+        for data, in self.connection.execute(query, params).fetchall():
+            row = json.loads(data)
+            if all(row.get(key) == value for key, value in filters.items()):
+                yield row
+
+    def set(self, row):
+        with self.db.atomic:
+            self.db._touch(self.name)
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO {self.quoted} (id, data) VALUES (?, ?)',
+                (row['id'], json.dumps(row)),
+            )
+
+    def delete(self, id):
+        with self.db.atomic:
+            self.db._touch(self.name)
+            cursor = self.connection.execute(f'DELETE FROM {self.quoted} WHERE id = ?', (id,))
+            if not cursor.rowcount:
+                raise KeyError(id)
+
+
+class SqliteQueue(_SqliteTable):
+    schema = 'seq INTEGER PRIMARY KEY AUTOINCREMENT, priority, data TEXT NOT NULL'
+    indexes = ('priority, seq',)
+
+    def _head(self):
+        row = self.connection.execute(
+            f'SELECT seq, priority, data FROM {self.quoted} ORDER BY priority, seq LIMIT 1'
+        ).fetchone()
+        if row is None:
+            raise IndexError('Queue is empty')
+        return row
+
+    def get_if(self, condition, blocking=True):
+        with self.listen() if blocking else nullcontext() as listener:
+            loop = repeat_if_needed(
+                exc_type=IndexError,
+                blocking=blocking,
+                sleep_time=FALLBACK_POLL_TIME,
+                error=QueueEmpty('Queue is empty'),
+                wait=listener and listener.wait,
+            )
+            for repeat_ctx in loop:
+                with repeat_ctx:
+                    # Pollers only peek in a read transaction, the write lock is for popping
+                    with self.atomic_read:
+                        seq, priority, data = self._head()
+                    if condition(priority):
+                        with self.db.atomic:
+                            seq, priority, data = self._head()
+                            if condition(priority):
+                                self.connection.execute(f'DELETE FROM {self.quoted} WHERE seq = ?', (seq,))
+                                return json.loads(data)
+
+    def get(self, blocking=True):
+        return self.get_if(lambda priority: True, blocking=blocking)
+
+    def next_priority(self):
+        row = self.connection.execute(
+            f'SELECT priority FROM {self.quoted} ORDER BY priority, seq LIMIT 1'
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, value, priority=0):
+        with self.db.atomic:
+            self.db._touch(self.name)
+            self.connection.execute(
+                f'INSERT INTO {self.quoted} (priority, data) VALUES (?, ?)',
+                (priority, json.dumps(value)),
+            )
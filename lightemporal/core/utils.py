@@ -1,8 +1,9 @@
+import asyncio
 import inspect
 import time
 from contextlib import contextmanager
 from functools import cached_property
-from typing import Annotated
+from typing import Annotated, Any
 from uuid import uuid4
 
 import pydantic
@@ -21,22 +22,30 @@ def _repeat_context(loop):
 
 
 class repeat_if_needed:
-    def __init__(self, *, exc_type=Exception, blocking=True, sleep_time=0.1, error=None):
+    def __init__(self, *, exc_type=Exception, blocking=True, sleep_time=0.1, error=None, wait=None):
         self.exc_type = exc_type
         self.blocking = blocking
         self.sleep_time = sleep_time
         self.error = error
+        self.wait = wait or time.sleep
 
     def __iter__(self):
         while True:
             yield _repeat_context(self)
 
             if self.blocking:
-                time.sleep(self.sleep_time)
+                self.wait(self.sleep_time)
             else:
                 raise self.error or RuntimeError()
 
 
+def run_if_coroutine(value):
+    # Async workflows and tasks get their own event loop when called from sync code
+    if inspect.iscoroutine(value):
+        return asyncio.run(value)
+    return value
+
+
 class SignatureWrapper:
     def __init__(self, signature):
         self.signature = signature
@@ -72,18 +81,18 @@ class SignatureWrapper:
     def output_adapter(self):
         return pydantic.TypeAdapter(self.signature.return_annotation)
 
-    def load_input(self, input: str):
-        args, kwargs = self.input_adapter.validate_json(input)
+    def load_input(self, input: Any):
+        args, kwargs = self.input_adapter.validate_python(input)
         return args, kwargs.model_dump()
 
-    def dump_input(self, *args, **kwargs) -> str:
+    def dump_input(self, *args, **kwargs) -> Any:
         bound = self.signature.bind(*args, **kwargs)
         args, kwargs = bound.args, bound.kwargs
         kwargs = self.kwargs_model(**kwargs)
-        return self.input_adapter.dump_json((args, kwargs)).decode()
+        return self.input_adapter.dump_python((args, kwargs), mode='json')
 
-    def load_output(self, output: str):
-        return self.output_adapter.validate_json(output)
+    def load_output(self, output: Any):
+        return self.output_adapter.validate_python(output)
 
-    def dump_output(self, value) -> str:
-        return self.output_adapter.dump_json(value).decode()
+    def dump_output(self, value) -> Any:
+        return self.output_adapter.dump_python(value, mode='json')
@@ -1,4 +1,5 @@
 import enum
+from typing import Any
 
 import pydantic
 
@@ -14,16 +15,23 @@ class WorkflowStatus(enum.Enum):
 class Workflow(pydantic.BaseModel):
     id: UUID
     name: str
-    input: str
+    input: Any
     status: WorkflowStatus = WorkflowStatus.RUNNING
+    completed_at: float | None = None
+    previous_id: str | None = None
+    next_id: str | None = None
+    # Shortcuts across continue_as_new chains: later runs point to the first, the first to the latest
+    first_id: str | None = None
+    latest_id: str | None = None
 
 
 class Activity(pydantic.BaseModel):
     id: UUID
     workflow_id: UUID
     name: str
-    input: str
-    output: str
+    input: Any
+    output: Any
+    error: str | None = None
 
 
 class Signal(pydantic.BaseModel):
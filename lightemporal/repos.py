@@ -1,14 +1,18 @@
+import time
 from functools import cached_property
+from typing import Any
 
 from .core.context import ENV
 from .models import Workflow, WorkflowStatus, Activity, Signal
+from .core.limits import Limiter
 
 
 class WorkflowRepository:
     def __init__(self, db):
         self.db = db.tables['workflows']
+        self.db.create_index('name', 'input', 'status')
 
-    def get_or_create(self, name: str, input: str, ok_stopped: bool = True) -> Workflow:
+    def get_or_create(self, name: str, input: Any, ok_stopped: bool = True) -> Workflow:
         with self.db.atomic:
             for row in self.db.list(name=name, input=input, status='RUNNING'):
                 raise ValueError('Workflow is already running')
@@ -18,6 +22,7 @@ class WorkflowRepository:
                 if not ok_stopped:
                     raise ValueError('Another stopped workflow already exists')
                 workflow.status = WorkflowStatus.RUNNING
+                workflow.completed_at = None
                 self.db.set(workflow.model_dump(mode='json'))
                 return workflow
                 workflow = Workflow.model_validate(row)
@@ -29,13 +34,45 @@ class WorkflowRepository:
     def get(self, workflow_id: str) -> Workflow:
         return Workflow.model_validate(self.db.get(workflow_id))
 
+    def latest(self, workflow_id: str) -> Workflow:
+        first = self.first(workflow_id)
+        workflow = first if first.latest_id is None else self.get(first.latest_id)
+        # Chains written before the shortcut existed are walked
+        while workflow.next_id is not None:
+            workflow = self.get(workflow.next_id)
+        return workflow
+
+    def first(self, workflow_id: str) -> Workflow:
+        workflow = self.get(workflow_id)
+        if workflow.first_id is not None:
+            return self.get(workflow.first_id)
+        while workflow.previous_id is not None:
+            workflow = self.get(workflow.previous_id)
+        return workflow
+
     def complete(self, workflow: Workflow) -> Workflow:
         workflow.status = WorkflowStatus.COMPLETED
+        workflow.completed_at = time.time()
         self.db.set(workflow.model_dump(mode='json'))
         return workflow
 
+    def continue_as_new(self, workflow: Workflow, input: Any) -> Workflow:
+        with self.db.atomic:
+            first = workflow if workflow.previous_id is None else self.first(workflow.id)
+            new = Workflow(name=workflow.name, input=input, previous_id=workflow.id, first_id=first.id)
+            self.db.set(new.model_dump(mode='json'))
+            workflow.next_id = new.id
+            if first is workflow:
+                workflow.latest_id = new.id
+            else:
+                first.latest_id = new.id
+                self.db.set(first.model_dump(mode='json'))
+            self.complete(workflow)
+            return new
+
     def failed(self, workflow: Workflow) -> Workflow:
         workflow.status = WorkflowStatus.STOPPED
+        workflow.completed_at = time.time()
         self.db.set(workflow.model_dump(mode='json'))
         return workflow
 
@@ -43,6 +80,8 @@ class WorkflowRepository:
 class ActivityRepository:
     def __init__(self, db):
         self.db = db.tables['activities']
+        self.db.create_index('workflow_id', 'name')
+        self.db.create_index('workflow_id')
 
     def save(self, activity: Activity) -> None:
         self.db.set(activity.model_dump(mode='json'))
@@ -52,15 +91,26 @@ class ActivityRepository:
             return Activity.model_validate(row)
         return None
 
+    def history(self, workflow_id) -> dict[str, Activity]:
+        return {row['name']: Activity.model_validate(row) for row in self.db.list(workflow_id=workflow_id)}
+
 
 class SignalRepository:
     def __init__(self, db):
         self.db = db.tables['signals']
+        self.db.create_index('workflow_id', 'name')
+        self.db.create_index('workflow_id')
 
     def new(self, signal: Signal) -> None:
         self.db.set(signal.model_dump(mode='json'))
 
     def may_find_one(self, workflow_id: str, name: str, step: int) -> Signal | None:
+        # Waiting workflows poll here, only take the write lock when there is a signal to claim
+        with self.db.atomic_read:
+            for row in self.db.list(workflow_id=workflow_id, name=name, step=step):
+                return Signal.model_validate(row)
+            if not any(True for _ in self.db.list(workflow_id=workflow_id, name=name, step=None)):
+                return None
         with self.db.atomic:
             for row in self.db.list(workflow_id=workflow_id, name=name, step=step):
                 return Signal.model_validate(row)
@@ -70,6 +120,13 @@ class SignalRepository:
                 return Signal.model_validate(row)
         return None
 
+    def history(self, workflow_id: str) -> dict[tuple[str, int], Signal]:
+        return {
+            (row['name'], row['step']): Signal.model_validate(row)
+            for row in self.db.list(workflow_id=workflow_id)
+            if row.get('step') is not None
+        }
+
 
 class Repositories:
     @cached_property
@@ -83,3 +140,7 @@ class Repositories:
     @cached_property
     def signals(self):
         return SignalRepository(ENV['DB'])
+
+    @cached_property
+    def limiter(self):
+        return Limiter(ENV['DB'])
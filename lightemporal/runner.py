@@ -1,9 +1,12 @@
+import asyncio
+import contextvars
 import threading
 import time
 from collections import defaultdict
 from contextlib import contextmanager
 
 from .core.context import ENV
+from .core.utils import run_if_coroutine
 
 
 class DirectExecution:
@@ -13,16 +16,32 @@ class DirectExecution:
     def suspend(self, workflow_id):
         raise RuntimeError('Cannot suspend sync workflow')
 
+    async def asuspend_until(self, workflow_id, timestamp):
+        await asyncio.sleep(max(timestamp - time.time(), 0))
+
+    async def asuspend(self, workflow_id):
+        self.suspend(workflow_id)
+
 
 class DirectRunner:
     def start(self, workflow, *args, **kwargs):
         raise RuntimeError('Cannot start async workflow with direct runner')
 
+    def start_many(self, workflow, arguments):
+        raise RuntimeError('Cannot start async workflow with direct runner')
+
     def run(self, workflow, *args, **kwargs):
         with ENV.new_layer():
             ENV['EXEC'] = DirectExecution()
             w_id = workflow._create(*args, **kwargs)
-            return workflow._run(w_id)
+            return run_if_coroutine(workflow._run(w_id))
+
+    def start_activity(self, activity, workflow_id, name, input_data):
+        # Nothing runs in parallel here, the future is done right away
+        try:
+            activity._run_started(workflow_id, name, input_data)
+        except Exception as e:
+            activity._save_error(workflow_id, name, input_data, e)
 
     def wake_up(self, id):
         raise RuntimeError('Cannot wake-up async workflow with direct runner')
@@ -33,8 +52,12 @@ class ThreadExecution(DirectExecution):
 
     def suspend(self, workflow_id):
         evt = self.events[workflow_id]
-        evt.clear()
+        # A wake-up that came before the wait is kept, callers check their condition again
         evt.wait()
+        evt.clear()
+
+    async def asuspend(self, workflow_id):
+        await asyncio.to_thread(self.suspend, workflow_id)
 
 
 class ThreadRunner:
@@ -43,10 +66,34 @@ class ThreadRunner:
         handler.start()
         return handler
 
+    def start_many(self, workflow, arguments):
+        handlers = []
+        for args in arguments:
+            # Same as the task runner: a failed start is reported in place of its handler
+            try:
+                handlers.append(self.start(workflow, *args))
+            except Exception as e:
+                handlers.append(e)
+        return handlers
+
     def run(self, workflow, *args, **kwargs):
         handler = self.start(workflow, *args, **kwargs)
         return handler.result()
 
+    def start_activity(self, activity, workflow_id, name, input_data):
+        thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._run_activity, activity, workflow_id, name, input_data),
+        )
+        thread.start()
+
+    def _run_activity(self, activity, workflow_id, name, input_data):
+        try:
+            activity._run_started(workflow_id, name, input_data)
+        except Exception as e:
+            activity._save_error(workflow_id, name, input_data, e)
+        self.wake_up(workflow_id)
+
     def wake_up(self, id):
         ThreadExecution.events[id].set()
 
@@ -66,7 +113,7 @@ class Handler:
             with ENV.new_layer():
                 ENV.update(parent_env)
                 ENV['EXEC'] = ThreadExecution()
-                self.ret = self._target(self.workflow_id)
+                self.ret = run_if_coroutine(self._target(self.workflow_id))
         except Exception as e:
             self.error = e
 
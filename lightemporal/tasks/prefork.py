@@ -0,0 +1,60 @@
+import os
+import signal
+import time
+import traceback
+
+
+class Supervisor:
+    def __init__(self, target, processes, restart_delay=1.0):
+        self.target = target
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.children = {}
+        self.stopping = False
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.target()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+        print('Started worker', pid)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.processes):
+            self._spawn()
+
+        while self.children:
+            pid, status = os.wait()
+            started = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            if code == 0:
+                print(f'Worker {pid} recycled')
+            else:
+                print(f'Worker {pid} exited with {code}, restarting')
+                # Do not spin when children crash right at startup
+                time.sleep(max(self.restart_delay - (time.monotonic() - started), 0))
+            if not self.stopping:
+                self._spawn()
@@ -2,63 +2,348 @@ import heapq
 import inspect
 import time
 from collections.abc import Callable
-from functools import cached_property
+from contextlib import nullcontext
+from functools import cached_property, partial
+from typing import Any
+from uuid import uuid4
 
 import pydantic
 
+from ..core.backend import QueueEmpty
 from ..core.context import ENV
+from ..core.limits import Limiter, find_limit
+from ..core.notify import FALLBACK_POLL_TIME, subscription
 from ..core.utils import repeat_if_needed, SignatureWrapper, UUID
 
 from .discovery import get_task_name
 
 
+DEDUP_TTL = 24 * 3600
+DEDUP_PURGE_INTERVAL = 60
+
+
 class Task(pydantic.BaseModel):
     id: UUID
     name: str
     timestamp: float
     retry_count: int
-    input: str
+    priority: int = 0
+    input: Any
 
 
 class TaskResult(pydantic.BaseModel):
     id: UUID
-    result: str | None = None
+    result: Any = None
     error: str | None = None
 
 
 class TaskRepository:
-    def __init__(self, db, queue_id):
+    def __init__(self, db, queue_id, lease_duration=300):
+        self.db = db
+        self.queue_id = queue_id
         self.queue = db.queues[f'queue.{queue_id}']
+        self.lane_table = db.tables[f'lanes.{queue_id}']
         self.suspended = db.tables[f'suspended.{queue_id}']
+        self.wakeups = db.tables[f'wakeups.{queue_id}']
         self.results = db.tables[f'results.{queue_id}']
+        self.inflight = db.tables[f'inflight.{queue_id}']
+        self.dedup = db.tables[f'dedup.{queue_id}']
+        self.limiter = Limiter(db)
+        self.lease_duration = lease_duration
+        self._dedup_purged_at = 0
+
+    def _lane(self, priority):
+        if not priority:
+            return self.queue
+        return self.db.queues[f'queue.{self.queue_id}.{priority}']
+
+    @property
+    def lanes(self):
+        priorities = {0, *(row['priority'] for row in self.lane_table.list())}
+        return [self._lane(priority) for priority in sorted(priorities, reverse=True)]
+
+    def _atomic(self, *tables):
+        return self.db.atomic_for(*(table.name for table in tables))
+
+    def _atomic_read(self, *tables):
+        return self.db.atomic_read_for(*(table.name for table in tables))
+
+    @property
+    def atomic(self):
+        return self._atomic(
+            *self.lanes, self.lane_table, self.suspended, self.wakeups, self.results, self.inflight, self.limiter.table,
+        )
 
-    def add(self, task):
-        row = task.model_dump(mode='json')
-        timestamp = row.pop('timestamp')
-        self.queue.put([timestamp, row])
-
-    def suspend(self, task):
-        self.suspended.set(task.model_dump(mode='json'))
+    def _release(self, row):
+        self.inflight.delete(row['id'])
+        if row.get('limit') is not None:
+            self.limiter.release(row['limit'], row['id'])
+
+    def _holds(self, task_id, lease):
+        if lease is None:
+            return True
+        try:
+            return self.inflight.get(task_id)['lease'] == lease
+        except KeyError:
+            return False
+
+    def _ack(self, task_id, lease):
+        if lease is not None:
+            self._release(self.inflight.get(task_id))
+
+    def _put(self, row):
+        self._lane(row.get('priority', 0)).put(row, priority=row['timestamp'])
+
+    def add(self, task, lease=None):
+        lane = self._lane(task.priority)
+        with self._atomic(lane, self.lane_table, self.inflight, self.limiter.table):
+            # The lease expired and the task went back to the queue, that copy is the one to run
+            if not self._holds(task.id, lease):
+                return
+            if task.priority:
+                try:
+                    self.lane_table.get(str(task.priority))
+                except KeyError:
+                    self.lane_table.set({'id': str(task.priority), 'priority': task.priority})
+            self._put(task.model_dump(mode='json'))
+            self._ack(task.id, lease)
+
+    def add_many(self, tasks):
+        lanes = {self._lane(task.priority) for task in tasks}
+        with self._atomic(*lanes, self.lane_table, self.inflight, self.limiter.table):
+            for task in tasks:
+                self.add(task)
+
+    def add_once(self, key, task, ttl):
+        now = time.time()
+        lane = self._lane(task.priority)
+        with self._atomic(self.dedup, self.results, lane, self.lane_table, self.inflight, self.limiter.table):
+            try:
+                row = self.dedup.get(key)
+            except KeyError:
+                row = None
+            if row is not None:
+                if row['expires'] > now:
+                    return row['task_id']
+                self._forget(row)
+            self.dedup.set({'id': key, 'task_id': str(task.id), 'expires': now + ttl})
+            self.add(task)
+            return task.id
+
+    def forget(self, key):
+        with self._atomic(self.dedup, self.results):
+            try:
+                self._forget(self.dedup.get(key))
+            except KeyError:
+                pass
+
+    def _forget(self, row):
+        self.dedup.delete(row['id'])
+        try:
+            self.results.delete(row['task_id'])
+        except KeyError:
+            pass
+
+    def purge_dedup(self, now=None):
+        now = time.time() if now is None else now
+        with self._atomic_read(self.dedup):
+            if not any(row['expires'] <= now for row in self.dedup.list()):
+                return 0
+        with self._atomic(self.dedup, self.results):
+            expired = [row for row in self.dedup.list() if row['expires'] <= now]
+            for row in expired:
+                self._forget(row)
+        return len(expired)
+
+    def purge_dedup_if_due(self, now=None):
+        now = time.time() if now is None else now
+        if now - self._dedup_purged_at < DEDUP_PURGE_INTERVAL:
+            return 0
+        self._dedup_purged_at = now
+        return self.purge_dedup(now)
+
+    def _pop_wakeup(self, task_id):
+        try:
+            self.wakeups.get(task_id)
+        except KeyError:
+            return False
+        self.wakeups.delete(task_id)
+        return True
+
+    def suspend(self, task, lease=None):
+        with self.atomic:
+            if not self._holds(task.id, lease):
+                return
+            if self._pop_wakeup(task.id):
+                # Woken up while running, go straight back to the queue
+                self.add(task, lease)
+                return
+            self.suspended.set(task.model_dump(mode='json'))
+            self._ack(task.id, lease)
 
     def wakeup(self, task_id):
-        with self.suspended.atomic:
-            data = self.suspended.get(task_id)
+        with self.atomic:
+            try:
+                data = self.suspended.get(task_id)
+            except KeyError:
+                # Still running, the next suspend returns right away. Queued or finished tasks need nothing.
+                try:
+                    self.inflight.get(task_id)
+                except KeyError:
+                    return
+                self.wakeups.set({'id': task_id})
+                return
             self.suspended.delete(task_id)
-        self.add(Task.model_validate(data))
-
-    def get_next_task(self):
-        timestamp, row = self.queue.get_if(lambda item: item[0] <= time.time())
-        return Task.model_validate({**row, 'timestamp': timestamp})
-
-    def get_result(self, task_id, blocking=True):
-        for repeat_ctx in repeat_if_needed(exc_type=KeyError, blocking=blocking):
-            with repeat_ctx, self.results.atomic:
-                result = self.results.get(task_id)
-                self.results.delete(task_id)
-                return TaskResult.model_validate(result)
-
-    def set_result(self, task_result):
-        self.results.set(task_result.model_dump(mode='json'))
+            self.add(Task.model_validate(data))
+
+    def requeue_expired(self):
+        now = time.time()
+        with self.atomic:
+            for row in list(self.inflight.list()):
+                if row['deadline'] < now:
+                    self._release(row)
+                    self._put(row['task'])
+
+    def subscribe(self, subscription):
+        # Lanes can appear while waiting, the lane registry notifies about them
+        subscription.add(self.lane_table, *self.lanes)
+
+    def _wait(self, subscription, timeout):
+        self.subscribe(subscription)
+        return subscription.wait(timeout)
+
+    def next_wakeup(self):
+        deadlines = [row['deadline'] for row in self.inflight.list()]
+        timestamp = self.next_timestamp()
+        if timestamp is not None:
+            deadlines.append(timestamp)
+        return min(deadlines, default=None)
+
+    def sleep_time(self, wakeup=None):
+        wakeup = self.next_wakeup() if wakeup is None else wakeup
+        if wakeup is None:
+            return FALLBACK_POLL_TIME
+        return min(max(wakeup - time.time(), 0), FALLBACK_POLL_TIME)
+
+    def get_next_tasks(self, max_items=1, blocking=True, limits=None):
+        with subscription() if blocking else nullcontext() as sub:
+            loop = repeat_if_needed(
+                exc_type=QueueEmpty,
+                blocking=blocking,
+                sleep_time=FALLBACK_POLL_TIME,
+                error=QueueEmpty('Queue is empty'),
+                wait=sub and partial(self._wait, sub),
+            )
+            if sub:
+                self.subscribe(sub)
+            for repeat_ctx in loop:
+                with repeat_ctx:
+                    # Idle workers poll under the read lock, the write lock is only taken when a task is due
+                    with self._atomic_read(*self.lanes, self.lane_table, self.inflight):
+                        wakeup = self.next_wakeup()
+                    if wakeup is None or wakeup > time.time():
+                        loop.sleep_time = self.sleep_time(wakeup)
+                        raise QueueEmpty('Queue is empty')
+                    with self.atomic:
+                        self.requeue_expired()
+                        tasks, deferred = [], []
+                        # Drain higher priority lanes first
+                        for lane in self.lanes:
+                            while len(tasks) < max_items:
+                                try:
+                                    row = lane.get_if(lambda timestamp: timestamp <= time.time(), blocking=False)
+                                except QueueEmpty:
+                                    break
+                                key = find_limit(limits, row['name'])
+                                if key is not None:
+                                    delay = self.limiter.acquire(key, limits[key], row['id'])
+                                    if delay:
+                                        deferred.append({**row, 'timestamp': time.time() + delay})
+                                        continue
+                                lease = str(uuid4())
+                                self.inflight.set({
+                                    'id': row['id'],
+                                    'lease': lease,
+                                    'deadline': time.time() + self.lease_duration,
+                                    'limit': key,
+                                    'task': row,
+                                })
+                                tasks.append((Task.model_validate(row), lease))
+                        # Limited tasks go back to their lane without blocking the others
+                        for row in deferred:
+                            self._put(row)
+                        if not tasks:
+                            loop.sleep_time = self.sleep_time()
+                            raise QueueEmpty('Queue is empty')
+                        return tasks
+
+    def get_next_task(self, blocking=True):
+        return self.get_next_tasks(1, blocking=blocking)[0]
+
+    def extend_lease(self, task_id, lease, duration=None):
+        with self.inflight.atomic:
+            try:
+                row = self.inflight.get(task_id)
+            except KeyError:
+                row = None
+            if row is None or row['lease'] != lease:
+                raise ValueError(f'Lease lost for task {task_id}')
+            row['deadline'] = time.time() + (self.lease_duration if duration is None else duration)
+            self.inflight.set(row)
+
+    def next_timestamp(self):
+        timestamps = [lane.next_priority() for lane in self.lanes]
+        return min((timestamp for timestamp in timestamps if timestamp is not None), default=None)
+
+    def get_result(self, task_id, blocking=True, keep=False):
+        for task_id, result in self.get_results([task_id], blocking=blocking, keep=keep):
+            return result
+
+    def get_results(self, task_ids, blocking=True, keep=False):
+        pending = set(task_ids)
+        with self.results.listen() if blocking else nullcontext() as listener:
+            for repeat_ctx in repeat_if_needed(
+                    exc_type=KeyError,
+                    blocking=blocking,
+                    sleep_time=FALLBACK_POLL_TIME,
+                    wait=listener and listener.wait,
+            ):
+                with repeat_ctx:
+                    # Collect every available result in a single read transaction
+                    with self.results.atomic_read:
+                        results = []
+                        for task_id in list(pending):
+                            try:
+                                results.append((task_id, TaskResult.model_validate(self.results.get(task_id))))
+                            except KeyError:
+                                continue
+                    for task_id, result in results:
+                        # Only consume a result when handing it out, a consumer may stop early
+                        if not keep:
+                            try:
+                                self.results.delete(task_id)
+                            except KeyError:
+                                # Consumed by another reader in the meantime
+                                continue
+                        pending.discard(task_id)
+                        yield task_id, result
+                    if pending:
+                        raise KeyError(next(iter(pending)))
+                    return
+
+    def set_result(self, task_result, lease=None):
+        with self._atomic(self.results, self.wakeups, self.inflight, self.limiter.table):
+            if not self._holds(task_result.id, lease):
+                return
+            self.results.set(task_result.model_dump(mode='json'))
+            self.done(task_result.id, lease)
+
+    def done(self, task_id, lease=None):
+        with self._atomic(self.wakeups, self.inflight, self.limiter.table):
+            if not self._holds(task_id, lease):
+                return
+            self._pop_wakeup(task_id)
+            self._ack(task_id, lease)
 
 
 class TaskFunction(pydantic.BaseModel):
@@ -68,6 +353,8 @@ class TaskFunction(pydantic.BaseModel):
     kwargs: dict
     timestamp: float = pydantic.Field(default_factory=time.time)
     retry_count: int = 0
+    priority: int = 0
+    lease: str | None = None
 
     @cached_property
     def name(self):
@@ -83,11 +370,12 @@ class TaskFunction(pydantic.BaseModel):
             name=self.name,
             input=self.sig.dump_input(*self.args, **self.kwargs),
             timestamp=self.timestamp,
-            retry_count=self.retry_count
+            retry_count=self.retry_count,
+            priority=self.priority,
         )
 
     @classmethod
-    def from_task(cls, func, task):
+    def from_task(cls, func, task, lease=None):
         sig = SignatureWrapper.from_function(func)
         assert get_task_name(func) == task.name
         args, kwargs = sig.load_input(task.input)
@@ -98,6 +386,8 @@ class TaskFunction(pydantic.BaseModel):
             kwargs=kwargs,
             timestamp=task.timestamp,
             retry_count=task.retry_count,
+            priority=task.priority,
+            lease=lease,
         )
         taskf.name = task.name
         taskf.sig = sig
@@ -116,51 +406,151 @@ class TaskFunction(pydantic.BaseModel):
 
 
 class FuncQueue:
-    def __init__(self, db, queue_id):
-        self.repo = TaskRepository(db, queue_id)
+    def __init__(self, db, queue_id, lease_duration=300):
+        self.repo = TaskRepository(db, queue_id, lease_duration=lease_duration)
+
+    @property
+    def queue_id(self):
+        return self.repo.queue_id
+
+    def named(self, queue_id):
+        if queue_id is None or queue_id == self.queue_id:
+            return self
+        return FuncQueue(self.repo.db, queue_id, lease_duration=self.repo.lease_duration)
 
     def put(self, task):
-        self.repo.add(task.to_task())
+        self.repo.add(task.to_task(), lease=task.lease)
         return task
 
     def call(self, func, /, *args, **kwargs):
         return self.put(TaskFunction(func=func, args=args, kwargs=kwargs))
 
+    def put_many(self, tasks):
+        tasks = list(tasks)
+        self.repo.add_many([task.to_task() for task in tasks])
+        return tasks
+
+    def call_many(self, func, arguments):
+        return self.put_many(TaskFunction(func=func, args=tuple(args), kwargs={}) for args in arguments)
+
+    def map(self, func, *iterables):
+        return self.call_many(func, zip(*iterables))
+
     def call_later(self, func, duration, /, *args, **kwargs):
-        return self.put(TaskFunction(func=func, args=args, kwargs=kwargs, duration=duration))
+        return self.put(TaskFunction(func=func, args=args, kwargs=kwargs).later(duration=duration))
 
     def call_at(self, func, timestamp, /, *args, **kwargs):
         return self.put(TaskFunction(func=func, args=args, kwargs=kwargs, timestamp=timestamp))
 
     def suspend(self, task):
-        self.repo.suspend(task.to_task())
+        self.repo.suspend(task.to_task(), lease=task.lease)
 
     def wakeup(self, task_id):
         self.repo.wakeup(task_id)
 
     def get(self, functions):
-        task = self.repo.get_next_task()
+        task, lease = self.repo.get_next_task()
         func = functions[task.name]
-        return TaskFunction.from_task(func, task)
+        return TaskFunction.from_task(func, task, lease=lease)
+
+    def get_many(self, functions, max_items, blocking=True, limits=None):
+        return [
+            TaskFunction.from_task(functions[task.name], task, lease=lease)
+            for task, lease in self.repo.get_next_tasks(max_items, blocking=blocking, limits=limits)
+        ]
+
+    @property
+    def atomic(self):
+        return self.repo.atomic
 
-    def get_result(self, func, task_id, blocking=True):
-        result = self.repo.get_result(task_id, blocking=blocking)
+    def subscribe(self, subscription):
+        self.repo.subscribe(subscription)
 
+    def sleep_time(self):
+        return self.repo.sleep_time()
+
+    def extend_lease(self, task, duration=None):
+        self.repo.extend_lease(task.id, task.lease, duration)
+
+    def next_timestamp(self):
+        return self.repo.next_timestamp()
+
+    def _load_result(self, func, result):
         if result.error is not None:
             raise ValueError(result.error)
 
         sig = SignatureWrapper.from_function(func)
         return sig.load_output(result.result)
 
+    def get_result(self, func, task_id, blocking=True, keep=False):
+        return self._load_result(func, self.repo.get_result(task_id, blocking=blocking, keep=keep))
+
+    def as_completed(self, func, task_ids, blocking=True):
+        for task_id, result in self.repo.get_results(task_ids, blocking=blocking):
+            yield task_id, self._load_result(func, result)
+
+    def gather(self, func, task_ids, return_exceptions=False):
+        task_ids = list(task_ids)
+        results = dict(self.repo.get_results(task_ids))
+        if not return_exceptions:
+            return [self._load_result(func, results[task_id]) for task_id in task_ids]
+        return [self._load_or_error(func, results[task_id]) for task_id in task_ids]
+
+    def _load_or_error(self, func, result):
+        try:
+            return self._load_result(func, result)
+        except Exception as e:
+            return e
+
     def set_result(self, task, result):
-        self.repo.set_result(TaskResult(id=task.id, result=task.sig.dump_output(result)))
+        self.repo.set_result(TaskResult(id=task.id, result=task.sig.dump_output(result)), lease=task.lease)
 
     def set_error(self, task, error_msg):
-        self.repo.set_result(TaskResult(id=task.id, error=error_msg))
+        self.repo.set_result(TaskResult(id=task.id, error=error_msg), lease=task.lease)
+
+    def done(self, task):
+        self.repo.done(task.id, lease=task.lease)
 
     def execute(self, func, /, *args, **kwargs):
         task_id = self.call(func, *args, **kwargs).id
         return self.get_result(func, task_id)
 
+    def idempotent(self, key, ttl=DEDUP_TTL):
+        return IdempotentQueue(self, key, ttl)
+
+    def purge_dedup(self, now=None):
+        return self.repo.purge_dedup(now)
+
+    def purge_dedup_if_due(self, now=None):
+        return self.repo.purge_dedup_if_due(now)
+
+    def forget(self, key):
+        self.repo.forget(key)
+
+
+class IdempotentQueue(FuncQueue):
+    def __init__(self, queue, key, ttl=DEDUP_TTL):
+        self.repo = queue.repo
+        self.key = key
+        self.ttl = ttl
+
+    def put(self, task):
+        task_id = self.repo.add_once(self.key, task.to_task(), self.ttl)
+        return task.model_copy(update={'id': task_id})
+
+    def put_many(self, tasks):
+        raise RuntimeError('An idempotency key covers a single task')
+
+    def call_many(self, func, arguments):
+        raise RuntimeError('An idempotency key covers a single task')
+
+    def map(self, func, *iterables):
+        raise RuntimeError('An idempotency key covers a single task')
+
+    def execute(self, func, /, *args, **kwargs):
+        task_id = self.call(func, *args, **kwargs).id
+        # Keep the result around for retries of the same key, purge_dedup drops it
+        return self.get_result(func, task_id, keep=True)
+
 
 ENV['Q'] = FuncQueue(ENV['DB'], 'tasks')
@@ -8,5 +8,8 @@ class RetryPolicy:
     delay: int = 0
     backoff: int = 1
 
+    def will_retry(self, error, retry_count):
+        return isinstance(error, self.error_type) and retry_count < self.max_retries
+
 
 DEFAULT_POLICY = RetryPolicy(Exception, 10)
@@ -1,50 +1,329 @@
-import sys
+import argparse
+import asyncio
+import contextvars
+import inspect
+import os
+import random
+import resource
+import signal
+import threading
 import time
+import traceback
 import types
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from importlib.metadata import EntryPoint
 
+from ..core.backend import QueueEmpty
 from ..core.context import ENV
+from ..core.notify import subscription
+from ..core.utils import run_if_coroutine
 
 from .discovery import load, get_task_name, discover_from_names
 from .exceptions import Suspend
+from .prefork import Supervisor
 from .retry import DEFAULT_POLICY
 
 
-def run_worker(retry_policy=DEFAULT_POLICY, /, **tasks):
+def _call_task(task, retry_policy=DEFAULT_POLICY):
+    with ENV.new_layer():
+        ENV['TASK'] = task
+        ENV['RETRY'] = retry_policy
+        return run_if_coroutine(task.func(*task.args, **task.kwargs))
+
+
+async def _call_task_async(task, retry_policy=DEFAULT_POLICY):
+    with ENV.new_layer():
+        ENV['TASK'] = task
+        ENV['RETRY'] = retry_policy
+        if inspect.iscoroutinefunction(task.func):
+            return await task.func(*task.args, **task.kwargs)
+        # Sync tasks would block the event loop
+        ret = await asyncio.to_thread(task.func, *task.args, **task.kwargs)
+        if inspect.iscoroutine(ret):
+            # Wrapped async functions, like workflow._run, only create their coroutine in the thread
+            ret = await ret
+        return ret
+
+
+def _on_error(queue, task, retry_policy, e):
+    if isinstance(e, Suspend):
+        if e.timestamp is None:
+            print(f'{task.name} suspended')
+            return partial(queue.suspend, task)
+        else:
+            print(f'{task.name} suspended for {round(max(e.timestamp - time.time(), 0))}s')
+            return partial(queue.put, task.later(timestamp=e.timestamp))
+    if isinstance(e, retry_policy.error_type):
+        print(f'{task.name} failed: {e!r}')
+        if task.retry_count < retry_policy.max_retries:
+            delay = retry_policy.delay * retry_policy.backoff ** task.retry_count
+            print(f'Retrying in {delay}s')
+            return partial(queue.put, task.retry(delay=delay))
+        else:
+            return partial(queue.set_error, task, str(e))
+
+
+def _on_success(queue, task, ret):
+    if getattr(task.func, 'no_result', False):
+        # Nobody reads the result, only release the task
+        return partial(queue.done, task)
+    return partial(queue.set_result, task, ret)
+
+
+def execute_task(queue, task, retry_policy=DEFAULT_POLICY):
+    print(task.func, task.args, task.kwargs)
+
+    try:
+        ret = _call_task(task, retry_policy)
+        print(repr(ret))
+    except Exception as e:
+        if (ack := _on_error(queue, task, retry_policy, e)) is None:
+            raise
+        return ack
+    else:
+        return _on_success(queue, task, ret)
+
+
+async def execute_task_async(queue, task, retry_policy=DEFAULT_POLICY):
+    print(task.func, task.args, task.kwargs)
+
+    try:
+        ret = await _call_task_async(task, retry_policy)
+        print(repr(ret))
+    except Exception as e:
+        if (ack := _on_error(queue, task, retry_policy, e)) is None:
+            raise
+        return ack
+    else:
+        return _on_success(queue, task, ret)
+
+
+class Executor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+    def execute(self, queue, task, retry_policy=DEFAULT_POLICY):
+        return execute_task(queue, task, retry_policy)
+
+    async def execute_async(self, queue, task, retry_policy=DEFAULT_POLICY):
+        return await execute_task_async(queue, task, retry_policy)
+
+
+def _weighted_order(queues):
+    # Weighted shuffle: each queue comes first with a probability proportional to its weight
+    return sorted(queues, key=lambda item: random.random() ** (1 / item[1]), reverse=True)
+
+
+class Lifetime:
+    def __init__(self, max_tasks=None, max_rss=None, stop=None):
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.stop = stop or threading.Event()
+        self.count = 0
+
+    @property
+    def expired(self):
+        if self.stop.is_set():
+            return True
+        if self.max_tasks is not None and self.count >= self.max_tasks:
+            return True
+        # ru_maxrss is in KiB on Linux, max_rss in MiB
+        return self.max_rss is not None and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss > self.max_rss * 1024
+
+
+def _get_batch(queues, tasks, prefetch, sub, limits, lifetime):
+    while not lifetime.expired:
+        for queue, _ in queues:
+            queue.subscribe(sub)
+            # Expired idempotency keys and the results they keep are only dropped here
+            queue.purge_dedup_if_due()
+        for queue, _ in _weighted_order(queues):
+            try:
+                return queue, queue.get_many(tasks, prefetch, blocking=False, limits=limits)
+            except QueueEmpty:
+                pass
+        sub.wait(min(queue.sleep_time() for queue, _ in queues))
+    return None, []
+
+
+def parse_queues(spec):
+    queues = {}
+    for item in filter(None, spec.split(',')):
+        name, _, weight = item.partition('=')
+        weight = float(weight or 1)
+        if not weight > 0:
+            raise ValueError(f'Queue weight must be positive: {item}')
+        queues[name.strip()] = weight
+    return queues
+
+
+def _execute_and_ack(queue, task, retry_policy, slots, executor):
+    try:
+        _ack(queue, executor.execute(queue, task, retry_policy))
+    except Exception:
+        # The lease expires and the task is requeued
+        traceback.print_exc()
+    finally:
+        slots.release()
+
+
+def _run_pool(queues, tasks, prefetch, sub, limits, lifetime, retry_policy, concurrency, executor):
+    slots = threading.BoundedSemaphore(concurrency)
+    # Leaving the executor waits for in-flight tasks
+    with ThreadPoolExecutor(concurrency) as pool:
+        while not lifetime.expired:
+            # Only dequeue what free threads can start right away
+            slots.acquire()
+            free = 1
+            while free < prefetch and slots.acquire(blocking=False):
+                free += 1
+            queue, batch = _get_batch(queues, tasks, free, sub, limits, lifetime)
+            lifetime.count += len(batch)
+            for _ in range(free - len(batch)):
+                slots.release()
+            for task in batch:
+                # Each task gets its own copy of the ENV layers and workflow contextvars
+                pool.submit(contextvars.copy_context().run, _execute_and_ack, queue, task, retry_policy, slots, executor)
+
+
+def _ack(queue, ack):
+    with queue.atomic:
+        ack()
+
+
+async def _execute_and_ack_async(queue, task, retry_policy, slots, executor):
+    try:
+        ack = await executor.execute_async(queue, task, retry_policy)
+        await asyncio.to_thread(_ack, queue, ack)
+    except Exception:
+        # The lease expires and the task is requeued
+        traceback.print_exc()
+    finally:
+        slots.release()
+
+
+async def _run_loop(queues, tasks, prefetch, sub, limits, lifetime, retry_policy, concurrency, executor):
+    slots = asyncio.BoundedSemaphore(concurrency)
+    running = set()
+    while not lifetime.expired:
+        await slots.acquire()
+        free = 1
+        while free < prefetch and not slots.locked():
+            await slots.acquire()
+            free += 1
+        # Waiting for tasks blocks on the notification sockets, keep it off the event loop
+        queue, batch = await asyncio.to_thread(_get_batch, queues, tasks, free, sub, limits, lifetime)
+        lifetime.count += len(batch)
+        for _ in range(free - len(batch)):
+            slots.release()
+        for task in batch:
+            # Tasks copy the current context, so each gets its own ENV layers and workflow contextvars
+            future = asyncio.create_task(_execute_and_ack_async(queue, task, retry_policy, slots, executor))
+            running.add(future)
+            future.add_done_callback(running.discard)
+    await asyncio.gather(*running)
+
+
+def run_worker(
+        retry_policy=DEFAULT_POLICY, /,
+        prefetch=1, queues=None, limits=None, concurrency=1, max_tasks=None, max_rss=None, stop=None,
+        use_asyncio=False, executor=None, **tasks,
+):
     queue = ENV['Q']
+    queues = [(queue.named(name), weight) for name, weight in (queues or {queue.queue_id: 1}).items()]
+    limits = {key if isinstance(key, str) else get_task_name(key): limit for key, limit in (limits or {}).items()}
+    lifetime = Lifetime(max_tasks, max_rss, stop)
 
     for name, func in sorted(tasks.items()):
         print('Loaded', name, ':', func)
 
-    while True:
-        task = queue.get(tasks)
-        print(task.func, task.args, task.kwargs)
-
-        try:
-            ret = task.func(*task.args, **task.kwargs)
-            print(repr(ret))
-        except Suspend as e:
-            if e.timestamp is None:
-                print(f'{task.name} suspended')
-                queue.suspend(task)
-            else:
-                print(f'{task.name} suspended for {round(max(e.timestamp - time.time(), 0))}s')
-                queue.put(task.later(timestamp=e.timestamp))
-        except retry_policy.error_type as e:
-            print(f'{task.name} failed: {e!r}')
-            if task.retry_count < retry_policy.max_retries:
-                delay = retry_policy.delay * retry_policy.backoff ** task.retry_count
-                print(f'Retrying in {delay}s')
-                queue.put(task.retry(delay=delay))
-            else:
-                queue.set_error(task, str(e))
-        else:
-            queue.set_result(task, ret)
+    with subscription() as sub, executor or Executor() as executor:
+        if use_asyncio:
+            asyncio.run(_run_loop(queues, tasks, prefetch, sub, limits, lifetime, retry_policy, concurrency, executor))
+            return
+
+        if concurrency > 1:
+            _run_pool(queues, tasks, prefetch, sub, limits, lifetime, retry_policy, concurrency, executor)
+            return
+
+        while not lifetime.expired:
+            queue, batch = _get_batch(queues, tasks, prefetch, sub, limits, lifetime)
+            if queue is None:
+                break
+            lifetime.count += len(batch)
+            for i, task in enumerate(batch):
+                if i:
+                    # The rest of the batch waited on the previous tasks, renew its lease before starting
+                    try:
+                        queue.extend_lease(task)
+                    except ValueError:
+                        # Expired and requeued meanwhile, it runs elsewhere
+                        continue
+                # Acknowledge each task as it finishes, an interruption keeps what is done
+                _ack(queue, executor.execute(queue, task, retry_policy))
+
+
+def _serve(retry_policy, options, tasks, child=False):
+    stop = threading.Event()
+    # Let the current tasks finish, then exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    if child:
+        # The supervisor turns Ctrl-C into a SIGTERM for every child
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(retry_policy, stop=stop, **options, **tasks)
+
+
+def run(
+        retry_policy=DEFAULT_POLICY, /,
+        processes=1, prefetch=1, queues=None, limits=None, concurrency=1, max_tasks=None, max_rss=None,
+        use_asyncio=False, executor=None, **tasks,
+):
+    tasks = {**load(), **tasks}
+    options = dict(
+        prefetch=prefetch,
+        queues=queues,
+        limits=limits,
+        concurrency=concurrency,
+        max_tasks=max_tasks,
+        max_rss=max_rss,
+        use_asyncio=use_asyncio,
+        executor=executor,
+    )
+
+    if processes > 1:
+        # Fork after discovery so that children share the imported code
+        Supervisor(partial(_serve, retry_policy, options, tasks, child=True), processes).run()
+    else:
+        _serve(retry_policy, options, tasks)
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lightemporal.tasks.worker')
+    parser.add_argument('names', nargs='*', help='modules or objects to discover tasks from')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='number of forked worker processes')
+    parser.add_argument('-c', '--concurrency', type=int, default=1, help='threads, or asyncio tasks, per process')
+    parser.add_argument('--asyncio', action='store_true', help='run tasks on an asyncio event loop')
+    parser.add_argument('--prefetch', type=int, default=1)
+    parser.add_argument('--queues', default=os.environ.get('LIGHTEMPORAL_QUEUES', ''), help='name=weight,...')
+    parser.add_argument('--max-tasks', type=int, help='recycle a process after this many tasks')
+    parser.add_argument('--max-rss', type=float, help='recycle a process above this RSS, in MiB')
+    args = parser.parse_args(argv)
 
-def run(retry_policy=DEFAULT_POLICY, /, **tasks):
-    run_worker(retry_policy, **load(), **tasks)
+    run(
+        processes=args.processes,
+        concurrency=args.concurrency,
+        use_asyncio=args.asyncio,
+        prefetch=args.prefetch,
+        queues=parse_queues(args.queues),
+        max_tasks=args.max_tasks,
+        max_rss=args.max_rss,
+        **discover_from_names(*args.names),
+    )
 
 
 if __name__ == '__main__':
-    run(**discover_from_names(*sys.argv[1:]))
+    main()
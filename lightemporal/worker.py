@@ -1,12 +1,24 @@
+import asyncio
+import contextvars
 import inspect
+import os
+import threading
 import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future
 from contextlib import contextmanager
 from functools import cached_property
+from typing import Any
 
 from .core.context import ENV
+from .core.notify import FALLBACK_POLL_TIME, subscription
 from .tasks.discovery import get_task_name
 from .tasks.exceptions import Suspend
-from .workflow import workflow
+from .tasks.queue import TaskFunction
+from .tasks.retry import DEFAULT_POLICY
+from .tasks.worker import Executor, execute_task
+from .workflow import workflow, activity, repos
 
 
 class TaskExecution:
@@ -16,34 +28,280 @@ class TaskExecution:
     def suspend(self, workflow_id):
         raise Suspend
 
+    async def asuspend_until(self, workflow_id, timestamp):
+        self.suspend_until(workflow_id, timestamp)
+
+    async def asuspend(self, workflow_id):
+        self.suspend(workflow_id)
+
+
+class StickyExecution(TaskExecution):
+    def __init__(self, execution):
+        self.execution = execution
+
+    def suspend_until(self, workflow_id, timestamp):
+        self.execution.pause(Suspend(timestamp=timestamp), timestamp)
+
+    def suspend(self, workflow_id):
+        self.execution.pause(Suspend())
+
+    async def asuspend_until(self, workflow_id, timestamp):
+        await asyncio.to_thread(self.suspend_until, workflow_id, timestamp)
+
+    async def asuspend(self, workflow_id):
+        await asyncio.to_thread(self.suspend, workflow_id)
+
+
+class _PausedExecution:
+    def __init__(self, cache, queue, task, retry_policy):
+        self.cache = cache
+        self.queue = queue
+        self.task = task
+        self.retry_policy = retry_policy
+        # Resolves with the ack, or None when the execution pauses
+        self.reported = Future()
+        self.evicted = False
+        self.lost = False
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.target,), daemon=True)
+
+    def target(self):
+        try:
+            self.run()
+        finally:
+            self.cache._done(self)
+
+    def run(self):
+        try:
+            with ENV.new_layer():
+                ENV['EXEC'] = StickyExecution(self)
+                ack = execute_task(self.queue, self.task, self.retry_policy)
+        except Exception as e:
+            if not self.reported.done():
+                self.reported.set_exception(e)
+            else:
+                # The lease expires and the task is requeued
+                traceback.print_exc()
+            return
+
+        if not self.reported.done():
+            self.reported.set_result(ack)
+        elif not self.lost:
+            # The worker already moved on, the lease is still ours
+            with self.queue.atomic:
+                ack()
+
+    def pause(self, exc, timestamp=None):
+        self.cache._pause(self)
+        if not self.reported.done():
+            # Hand the worker back its slot, without acknowledging the task
+            self.reported.set_result(None)
+        with self.cache.condition:
+            generation = self.cache.generation
+            while not self.evicted:
+                if timestamp is not None and time.time() >= timestamp:
+                    break
+                if timestamp is None and self.cache.generation != generation:
+                    # Signals arrived, let the workflow check them
+                    break
+                self.cache.condition.wait(FALLBACK_POLL_TIME)
+        self.cache._resume(self)
+        if self.evicted:
+            # Fall back to a regular suspension, the next run replays
+            raise exc
+
+
+def _rss():
+    # Current resident memory in MiB, ru_maxrss only gives the peak
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+class StickyExecutor(Executor):
+    def __init__(self, max_size=100, max_memory=None):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.paused = OrderedDict()
+        self.running = set()
+        self.closing = False
+        self.watcher = None
+
+    def _start(self, queue, task, retry_policy):
+        execution = _PausedExecution(self, queue, task, retry_policy)
+        with self.condition:
+            self.running.add(execution)
+        execution.thread.start()
+        return execution.reported
+
+    def execute(self, queue, task, retry_policy=DEFAULT_POLICY):
+        if not getattr(task.func, 'sticky', False):
+            return super().execute(queue, task, retry_policy)
+        # Paused executions keep the lease and acknowledge when they end
+        return self._start(queue, task, retry_policy).result() or _noop
+
+    async def execute_async(self, queue, task, retry_policy=DEFAULT_POLICY):
+        if not getattr(task.func, 'sticky', False):
+            return await super().execute_async(queue, task, retry_policy)
+        return await asyncio.wrap_future(self._start(queue, task, retry_policy)) or _noop
+
+    def _pause(self, execution):
+        with self.condition:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=contextvars.copy_context().run, args=(self._watch,), daemon=True)
+                self.watcher.start()
+            self.paused[execution.task.id] = execution
+            if self.closing:
+                execution.evicted = True
+            while self.paused and (
+                    len(self.paused) > self.max_size
+                    or self.max_memory is not None and _rss() > self.max_memory
+            ):
+                _, evicted = self.paused.popitem(last=False)
+                evicted.evicted = True
+            self.condition.notify_all()
+
+    def _resume(self, execution):
+        with self.condition:
+            self.paused.pop(execution.task.id, None)
+
+    def _done(self, execution):
+        with self.condition:
+            self.running.discard(execution)
+            self.condition.notify_all()
+
+    def _watch(self):
+        heartbeat = time.monotonic()
+        with subscription() as sub:
+            # Paused runs wait for signals or for started activities
+            sub.add(repos.signals.db, repos.activities.db)
+            while not self.closing:
+                # Only wake paused runs on a notification, unless there is no channel to get one
+                notified = sub.wait(FALLBACK_POLL_TIME) or not sub.sockets
+                with self.condition:
+                    if notified:
+                        self.generation += 1
+                        self.condition.notify_all()
+                    paused = list(self.paused.values())
+                if paused and time.monotonic() - heartbeat > paused[0].queue.repo.lease_duration / 3:
+                    heartbeat = time.monotonic()
+                    for execution in paused:
+                        self._extend(execution)
+
+    def _extend(self, execution):
+        try:
+            execution.queue.extend_lease(execution.task)
+        except ValueError:
+            # Another worker took the task over, drop this execution
+            with self.condition:
+                execution.lost = execution.evicted = True
+                self.condition.notify_all()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        with self.condition:
+            self.closing = True
+            for execution in self.paused.values():
+                execution.evicted = True
+            self.condition.notify_all()
+            # Resumed executions either finish or get evicted at their next pause
+            while self.running:
+                self.condition.wait()
+
+
+def _noop():
+    pass
+
 
 class TaskRunner:
     @cached_property
     def workflow_table(self):
         return ENV['DB'].tables['tasks.workflows']
 
+    def _call(self, workflow, func, *args, **kwargs):
+        queue = ENV['Q'].named(workflow.queue)
+        task = queue.put(TaskFunction(func=func, args=args, kwargs=kwargs, priority=workflow.priority))
+        return queue, task
+
+    def _execute(self, workflow, func, *args, **kwargs):
+        queue, task = self._call(workflow, func, *args, **kwargs)
+        return queue.get_result(func, task.id)
+
+    def _call_many(self, workflow, func, arguments):
+        queue = ENV['Q'].named(workflow.queue)
+        tasks = queue.put_many(
+            TaskFunction(func=func, args=tuple(args), kwargs={}, priority=workflow.priority)
+            for args in arguments
+        )
+        return queue, tasks
+
+    def start_many(self, workflow, arguments):
+        queue, tasks = self._call_many(workflow, workflow._create, arguments)
+        # A failed creation doesn't hold back the others, its error takes the place of the handler
+        created = queue.gather(workflow._create, [task.id for task in tasks], return_exceptions=True)
+        workflow_ids = [workflow_id for workflow_id in created if not isinstance(workflow_id, Exception)]
+        queue, tasks = self._call_many(workflow, workflow._run, [(workflow_id,) for workflow_id in workflow_ids])
+        with self.workflow_table.atomic:
+            for workflow_id, task in zip(workflow_ids, tasks):
+                self.workflow_table.set({'id': workflow_id, 'task_id': task.id, 'queue': queue.queue_id})
+        handlers = iter([Handler(workflow, workflow_id, task.id, queue) for workflow_id, task in zip(workflow_ids, tasks)])
+        return [item if isinstance(item, Exception) else next(handlers) for item in created]
+
     def start(self, workflow, *args, **kwargs):
-        workflow_id = ENV['Q'].execute(workflow._create, *args, **kwargs)
-        task = ENV['Q'].call(workflow._run, workflow_id)
-        self.workflow_table.set({'id': workflow_id, 'task_id': task.id})
-        return Handler(workflow, workflow_id, task.id)
+        workflow_id = self._execute(workflow, workflow._create, *args, **kwargs)
+        queue, task = self._call(workflow, workflow._run, workflow_id)
+        self.workflow_table.set({'id': workflow_id, 'task_id': task.id, 'queue': queue.queue_id})
+        return Handler(workflow, workflow_id, task.id, queue)
 
     def run(self, workflow, *args, **kwargs):
-        return ENV['Q'].execute(workflow.run, *args, **kwargs)
+        return self._execute(workflow, workflow.run, *args, **kwargs)
+
+    def _task_for(self, workflow_id):
+        # Runs continued as new share the task of the first run
+        data = self.workflow_table.get(repos.workflows.first(workflow_id).id)
+        return ENV['Q'].named(data.get('queue')), data['task_id']
+
+    def start_activity(self, activity, workflow_id, name, input_data):
+        queue, _ = self._task_for(workflow_id)
+        # Replays start the same step again, the key makes that a no-op
+        queue.idempotent(f'{workflow_id}:{name}').call(_run_activity, workflow_id, activity.key, name, input_data)
 
     def wake_up(self, workflow_id):
-        data = self.workflow_table.get(workflow_id)
-        ENV['Q'].wakeup(data['task_id'])
+        queue, task_id = self._task_for(workflow_id)
+        queue.wakeup(task_id)
+
+    def forget_activity(self, workflow_id, name):
+        # Recorded activities are found by replays, the start key is only needed until then
+        queue, _ = self._task_for(workflow_id)
+        queue.forget(f'{workflow_id}:{name}')
+
+
+def _run_activity(workflow_id: str, activity_key: str, name: str, input: Any) -> None:
+    act = activity.named(activity_key)
+    try:
+        act._run_started(workflow_id, name, input)
+    except Suspend:
+        raise
+    except Exception as e:
+        if ENV['RETRY'].will_retry(e, ENV['TASK'].retry_count):
+            raise
+        # Out of retries, the workflow gets the error through the future
+        act._save_error(workflow_id, name, input, e)
+    ENV['RUN'].forget_activity(workflow_id, name)
+    ENV['RUN'].wake_up(workflow_id)
+
+
+_run_activity.no_result = True
 
 
 class Handler:
-    def __init__(self, workflow, workflow_id, task_id):
+    def __init__(self, workflow, workflow_id, task_id, queue):
         self.workflow = workflow
         self.workflow_id = workflow_id
         self.task_id = task_id
+        self.queue = queue
 
     def result(self):
-        return ENV['Q'].get_result(self.workflow, self.task_id)
+        return self.queue.get_result(self.workflow, self.task_id)
 
 
 def decorate_workflows():
@@ -68,6 +326,7 @@ def decorate_workflows():
         )
         w._run = MethodWrapper(
             w._run,
+            sticky=True,
             __taskname__=w.__taskname__+'._run',
             __signature__=inspect.signature(w._run).replace(return_annotation=w.__signature__.return_annotation),
         )
@@ -102,6 +361,7 @@ def discover_tasks_from_workflow(workflow):
         get_task_name(workflow._create): workflow._create,
         get_task_name(workflow._run): workflow._run,
         get_task_name(workflow.run): workflow.run,
+        get_task_name(_run_activity): _run_activity,
     }
 
 
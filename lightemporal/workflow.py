@@ -1,12 +1,14 @@
+import asyncio
 import contextvars
 import inspect
 import time
 from contextlib import contextmanager
+from functools import partial
 
 import pydantic
 
 from .core.context import ENV
-from .core.utils import SignatureWrapper
+from .core.utils import SignatureWrapper, run_if_coroutine
 from .models import Workflow, WorkflowStatus, Activity, Signal
 from .repos import Repositories
 
@@ -16,24 +18,53 @@ repos = Repositories()
 class WorkflowContext(pydantic.BaseModel):
     id: str
     step: int = 0
+    is_async: bool = False
+    # History loaded once per run, replayed steps don't hit the database
+    activities: dict[str, Activity] = {}
+    signals: dict[tuple[str, int], Signal] = {}
 
     def next_step(self):
         self.step += 1
         return self.step
 
+    def find_activity(self, name, input):
+        activity = self.activities.get(name)
+        if activity is not None and activity.input == input:
+            return activity
+        return None
+
+    def find_signal(self, name, step):
+        if (name, step) in self.signals:
+            return self.signals[name, step]
+        # Only signals that arrived since the run started are still unclaimed
+        return repos.signals.may_find_one(self.id, name, step)
+
+
+class ContinueAsNew(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.args = args
+        self.kwargs = kwargs
+
 
 class workflow:
     instances = []
     _currents = contextvars.ContextVar('current_workflows', default=())
 
-    def __init__(self, func):
+    def __init__(self, func, queue=None, priority=0):
         self.func = func
         self.name = func.__qualname__
         self.sig = SignatureWrapper.from_function(func)
         self.__signature__ = self.sig.signature
+        self.queue = queue
+        self.priority = priority
 
         self.instances.append(self)
 
+    @classmethod
+    def options(cls, **options):
+        return partial(cls, **options)
+
     @classmethod
     def _current(cls):
         currents = cls._currents.get()
@@ -42,8 +73,17 @@ class workflow:
         return currents[-1]
 
     @classmethod
-    def _enter_workflow(cls, workflow):
-        cls._currents.set((*cls._currents.get(), WorkflowContext(id=workflow.id)))
+    def _load_context(cls, workflow, is_async=False):
+        return WorkflowContext(
+            id=workflow.id,
+            is_async=is_async,
+            activities=repos.activities.history(workflow.id),
+            signals=repos.signals.history(workflow.id),
+        )
+
+    @classmethod
+    def _enter_workflow(cls, workflow_ctx):
+        cls._currents.set((*cls._currents.get(), workflow_ctx))
 
     @classmethod
     def _exit_workflow(cls, workflow):
@@ -56,58 +96,135 @@ class workflow:
     def start(self, *args, **kwargs):
         return ENV['RUN'].start(self, *args, **kwargs)
 
+    def start_many(self, arguments):
+        return ENV['RUN'].start_many(self, arguments)
+
     def __call__(self, *args, **kwargs):
         return ENV['RUN'].run(self, *args, **kwargs)
 
     def _create(self, *args, **kwargs):
-        input_str = self.sig.dump_input(*args, **kwargs)
-        workflow = repos.workflows.get_or_create(self.name, input_str)
+        input_data = self.sig.dump_input(*args, **kwargs)
+        workflow = repos.workflows.get_or_create(self.name, input_data)
         return workflow.id
 
     def _run(self, workflow_id: str):
-        workflow = repos.workflows.get(workflow_id)
-        print(repr(workflow))
+        if inspect.iscoroutinefunction(self.func):
+            return self._run_async(workflow_id)
 
-        args, kwargs = self.sig.load_input(workflow.input)
-        self._enter_workflow(workflow)
+        while True:
+            # Resumed tasks go straight to the latest run of the chain
+            workflow = repos.workflows.latest(workflow_id)
+            print(repr(workflow))
+
+            args, kwargs = self.sig.load_input(workflow.input)
+            self._enter_workflow(self._load_context(workflow))
+
+            outcome = repos.workflows.complete
+
+            try:
+                return self.func(*args, **kwargs)
+            except ContinueAsNew as e:
+                outcome = partial(repos.workflows.continue_as_new, input=self.sig.dump_input(*e.args, **e.kwargs))
+            except Exception:
+                outcome = repos.workflows.failed
+                raise
+            finally:
+                self._exit_workflow(workflow)
+                outcome(workflow)
+
+    async def _run_async(self, workflow_id):
+        while True:
+            workflow = await asyncio.to_thread(repos.workflows.latest, workflow_id)
+            print(repr(workflow))
 
-        exc = False
+            args, kwargs = self.sig.load_input(workflow.input)
+            self._enter_workflow(await asyncio.to_thread(self._load_context, workflow, is_async=True))
 
-        try:
-            return self.func(*args, **kwargs)
-        except Exception:
-            exc = True
-            raise
-        finally:
-            self._exit_workflow(workflow)
-            if exc:
-                repos.workflows.failed(workflow)
-            else:
-                repos.workflows.complete(workflow)
+            outcome = repos.workflows.complete
+
+            try:
+                return await self.func(*args, **kwargs)
+            except ContinueAsNew as e:
+                outcome = partial(repos.workflows.continue_as_new, input=self.sig.dump_input(*e.args, **e.kwargs))
+            except Exception:
+                outcome = repos.workflows.failed
+                raise
+            finally:
+                self._exit_workflow(workflow)
+                await asyncio.to_thread(outcome, workflow)
 
     @contextmanager
     def use(self, *args, **kwargs):
-        input_str = self.sig.dump_input(*args, **kwargs)
-        workflow = repos.workflows.get_or_create(self.name, input_str)
+        input_data = self.sig.dump_input(*args, **kwargs)
+        workflow = repos.workflows.get_or_create(self.name, input_data)
         try:
             yield
         finally:
             repos.workflows.complete(workflow)
 
-    @staticmethod
-    def sleep(duration):
+    @classmethod
+    def sleep(cls, duration):
+        if cls._current().is_async:
+            return _sleep_async(duration)
         return _sleep_until(_timestamp_for_duration(duration))
 
     @classmethod
     def wait(cls, signal_cls):
+        if cls._current().is_async:
+            return cls._wait_async(signal_cls)
+        workflow_ctx = cls._current()
+        # Executions that resume in place retry the same step
+        step = workflow_ctx.next_step()
+        while True:
+            if signal := workflow_ctx.find_signal(signal_cls.__signal_name__, step):
+                return signal_cls.model_validate(signal.content)
+            ENV['EXEC'].suspend(workflow_ctx.id)
+
+    @classmethod
+    async def _wait_async(cls, signal_cls):
+        workflow_ctx = cls._current()
+        step = workflow_ctx.next_step()
         while True:
-            workflow_ctx = cls._current()
-            if signal := repos.signals.may_find_one(workflow_ctx.id, signal_cls.__signal_name__, workflow_ctx.next_step()):
+            if signal := await asyncio.to_thread(workflow_ctx.find_signal, signal_cls.__signal_name__, step):
                 return signal_cls.model_validate(signal.content)
+            await ENV['EXEC'].asuspend(workflow_ctx.id)
+
+    @classmethod
+    def gather(cls, *futures):
+        if cls._current().is_async:
+            return cls._gather_async(futures)
+        return [future.result() for future in futures]
+
+    @classmethod
+    async def _gather_async(cls, futures):
+        return [await future for future in futures]
+
+    @classmethod
+    def wait_any(cls, *futures):
+        workflow_ctx = cls._current()
+        name = f'wait_any#{workflow_ctx.next_step()}'
+        input_data = [future.name for future in futures]
+        if workflow_ctx.is_async:
+            return cls._wait_any_async(workflow_ctx, name, input_data, futures)
+        while (index := _first_done(workflow_ctx, name, input_data, futures)) is None:
             ENV['EXEC'].suspend(workflow_ctx.id)
+        return futures[index]
+
+    @classmethod
+    async def _wait_any_async(cls, workflow_ctx, name, input_data, futures):
+        while (index := await asyncio.to_thread(_first_done, workflow_ctx, name, input_data, futures)) is None:
+            await ENV['EXEC'].asuspend(workflow_ctx.id)
+        return futures[index]
+
+    @classmethod
+    def continue_as_new(cls, *args, **kwargs):
+        cls._current()
+        raise ContinueAsNew(*args, **kwargs)
 
     @staticmethod
     def signal(workflow_id: str, signal):
+        # Signals go to the latest run of the chain
+        workflow_id = repos.workflows.latest(workflow_id).id
         repos.signals.new(Signal(
             workflow_id=workflow_id,
             name=type(signal).__signal_name__,
@@ -116,34 +233,147 @@ class workflow:
         ENV['RUN'].wake_up(workflow_id)
 
 
+def _first_done(workflow_ctx, name, input_data, futures):
+    # The first completion is recorded, so that replay picks the same future
+    if (record := workflow_ctx.find_activity(name, input_data)) is not None:
+        return record.output
+    for index, future in enumerate(futures):
+        if future.done():
+            repos.activities.save(Activity(workflow_id=workflow_ctx.id, name=name, input=input_data, output=index))
+            return index
+    return None
+
+
+class ActivityFuture:
+    def __init__(self, activity, workflow_ctx, name, input_data):
+        self.activity = activity
+        self.workflow_ctx = workflow_ctx
+        self.name = name
+        self.input_data = input_data
+        self._record = workflow_ctx.find_activity(name, input_data)
+
+    def done(self):
+        if self._record is None:
+            self._record = repos.activities.may_find_one(self.workflow_ctx.id, self.name, self.input_data)
+        return self._record is not None
+
+    def result(self):
+        if self.workflow_ctx.is_async:
+            return self._result_async()
+        while not self.done():
+            ENV['EXEC'].suspend(self.workflow_ctx.id)
+        return self._load()
+
+    async def _result_async(self):
+        while not await asyncio.to_thread(self.done):
+            await ENV['EXEC'].asuspend(self.workflow_ctx.id)
+        return self._load()
+
+    def __await__(self):
+        return self._result_async().__await__()
+
+    def _load(self):
+        if self._record.error is not None:
+            raise ValueError(self._record.error)
+        return self.activity.sig.load_output(self._record.output)
+
+
 class activity:
-    def __init__(self, func):
+    instances = {}
+
+    def __init__(self, func, limit=None):
         self.func = func
         self.name = func.__qualname__
+        self.key = f'{func.__module__}:{func.__qualname__}'
         self.sig = SignatureWrapper.from_function(func)
+        self.limit = limit
 
-    def __call__(self, *args, **kwargs):
+        self.instances[self.key] = self
+
+    @classmethod
+    def options(cls, **options):
+        return partial(cls, **options)
+
+    @classmethod
+    def named(cls, key):
+        return cls.instances[key]
+
+    def start(self, *args, **kwargs):
         workflow_ctx = workflow._current()
-        exc = None
+        input_data = self.sig.dump_input(*args, **kwargs)
+        future = ActivityFuture(self, workflow_ctx, f'{self.name}#{workflow_ctx.next_step()}', input_data)
+        if future._record is None:
+            ENV['RUN'].start_activity(self, workflow_ctx.id, future.name, input_data)
+        return future
 
-        input_str = self.sig.dump_input(*args, **kwargs)
+    def _run_started(self, workflow_id, name, input_data):
+        if repos.activities.may_find_one(workflow_id, name, input_data) is not None:
+            return
 
+        args, kwargs = self.sig.load_input(input_data)
+        holder = f'{workflow_id}:{name}'
+        if self.limit is not None:
+            self._acquire(workflow_id, holder)
+
+        try:
+            ret = run_if_coroutine(self.func(*args, **kwargs))
+        finally:
+            if self.limit is not None:
+                repos.limiter.release(self.name, holder)
+        self._save(workflow_id, name, input_data, ret)
+
+    def _save_error(self, workflow_id, name, input_data, error):
+        # Nothing awaits a started activity, its final error is recorded for the future
+        repos.activities.save(Activity(workflow_id=workflow_id, name=name, input=input_data, output=None, error=str(error)))
+
+    def _acquire(self, workflow_id, holder):
+        while delay := repos.limiter.acquire(self.name, self.limit, holder):
+            ENV['EXEC'].suspend_until(workflow_id, time.time() + delay)
+
+    def __call__(self, *args, **kwargs):
+        workflow_ctx = workflow._current()
+        input_data = self.sig.dump_input(*args, **kwargs)
+        # Steps are numbered at call time, so that replay order doesn't depend on scheduling
         name = f'{self.name}#{workflow_ctx.next_step()}'
-        activity = repos.activities.may_find_one(workflow_ctx.id, name, input_str)
-        if activity is not None:
+        if inspect.iscoroutinefunction(self.func):
+            return self._call_async(workflow_ctx, name, input_data, args, kwargs)
+
+        if (activity := workflow_ctx.find_activity(name, input_data)) is not None:
             return self.sig.load_output(activity.output)
 
+        holder = f'{workflow_ctx.id}:{name}'
+        if self.limit is not None:
+            self._acquire(workflow_ctx.id, holder)
+
         try:
             ret = self.func(*args, **kwargs)
-            return ret
-        except Exception:
-            exc = True
-            raise
         finally:
-            if not exc:
-                output_str = self.sig.dump_output(ret)
-                activity = Activity(workflow_id=workflow_ctx.id, name=name, input=input_str, output=output_str)
-                repos.activities.save(activity)
+            if self.limit is not None:
+                repos.limiter.release(self.name, holder)
+        self._save(workflow_ctx.id, name, input_data, ret)
+        return ret
+
+    async def _call_async(self, workflow_ctx, name, input_data, args, kwargs):
+        if (activity := workflow_ctx.find_activity(name, input_data)) is not None:
+            return self.sig.load_output(activity.output)
+
+        holder = f'{workflow_ctx.id}:{name}'
+        if self.limit is not None:
+            while delay := await asyncio.to_thread(repos.limiter.acquire, self.name, self.limit, holder):
+                await ENV['EXEC'].asuspend_until(workflow_ctx.id, time.time() + delay)
+
+        try:
+            ret = await self.func(*args, **kwargs)
+        finally:
+            if self.limit is not None:
+                await asyncio.to_thread(repos.limiter.release, self.name, holder)
+        await asyncio.to_thread(self._save, workflow_ctx.id, name, input_data, ret)
+        return ret
+
+    def _save(self, workflow_id, name, input_data, ret):
+        output_data = self.sig.dump_output(ret)
+        activity = Activity(workflow_id=workflow_id, name=name, input=input_data, output=output_data)
+        repos.activities.save(activity)
 
 
 @activity
@@ -157,6 +387,21 @@ def _sleep_until(timestamp: float) -> None:
         ENV['EXEC'].suspend_until(workflow._current().id, timestamp)
 
 
+@activity
+async def _timestamp_for_duration_async(duration: int) -> float:
+    return time.time() + duration
+
+
+@activity
+async def _sleep_until_async(timestamp: float) -> None:
+    if timestamp > time.time():
+        await ENV['EXEC'].asuspend_until(workflow._current().id, timestamp)
+
+
+async def _sleep_async(duration):
+    return await _sleep_until_async(await _timestamp_for_duration_async(duration))
+
+
 def signal(f):
     f.__signal_name__ = f.__name__
     return f